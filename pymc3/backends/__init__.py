@@ -6,9 +6,13 @@ Available backends
 1. NumPy array (pymc3.backends.NDArray)
 2. Text files (pymc3.backends.Text)
 3. SQLite (pymc3.backends.SQLite)
+4. Memory-mapped NumPy arrays (pymc3.backends.Memmap)
 
 The NDArray backend holds the entire trace in memory, whereas the Text
-and SQLite backends store the values while sampling.
+and SQLite backends store the values while sampling. The Memmap backend
+writes the values in place into memory-mapped .npy files, so traces
+sampled in worker processes (`njobs` > 1) are not copied back to the
+parent process.
 
 Selecting a backend
 -------------------
@@ -111,13 +115,16 @@ object that provides a consistent selection interface for all backends.
 If the traces are stored on disk, then a `load` function should also be
 defined that returns a MultiTrace object.
 
-For specific examples, see pymc3.backends.{ndarray,text,sqlite}.py.
+For specific examples, see pymc3.backends.{ndarray,text,sqlite,memmap}.py.
 """
 from ..backends.ndarray import NDArray
 from ..backends.text import Text
 from ..backends.sqlite import SQLite
+from ..backends.memmap import Memmap
 
 _shortcuts = {'text': {'backend': Text,
                        'name': 'mcmc'},
               'sqlite': {'backend': SQLite,
-                         'name': 'mcmc.sqlite'}}
+                         'name': 'mcmc.sqlite'},
+              'memmap': {'backend': Memmap,
+                         'name': 'mcmc-memmap'}}
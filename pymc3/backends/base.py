@@ -44,6 +44,8 @@ class BaseTrace(object):
         self.var_dtypes = {var: value.dtype
                            for var, value in var_values}
         self.chain = None
+        ## Seconds taken to sample the chain, set by the sampler.
+        self.sampling_time = None
 
     ## Sampling methods
 
@@ -116,6 +118,55 @@ class BaseTrace(object):
         raise NotImplementedError
 
 
+class TraceView(BaseTrace):
+    """Read-only view of the first draws of a trace that is being sampled
+
+    Creating a view does not copy the values or set up a new backend, so it
+    takes constant time. The view shows the first `draws` draws of the
+    trace, and grows as `draws` is increased.
+
+    Parameters
+    ----------
+    strace : BaseTrace
+    draws : int
+        Number of draws shown
+    """
+    def __init__(self, strace, draws=0):
+        self.strace = strace
+        self.draws = draws
+
+        self.name = strace.name
+        self.model = strace.model
+        self.vars = strace.vars
+        self.varnames = strace.varnames
+        self.fn = strace.fn
+        self.var_shapes = strace.var_shapes
+        self.var_dtypes = strace.var_dtypes
+        self.chain = strace.chain
+
+    @property
+    def sampling_time(self):
+        return self.strace.sampling_time
+
+    def setup(self, draws, chain):
+        raise BackendError('Trace views are read-only')
+
+    def record(self, point):
+        raise BackendError('Trace views are read-only')
+
+    def __len__(self):
+        return self.draws
+
+    def get_values(self, varname, burn=0, thin=1):
+        return self.strace.get_values(varname)[:self.draws][burn::thin]
+
+    def _slice(self, idx):
+        return self.strace._slice(slice(*idx.indices(self.draws)))
+
+    def point(self, idx):
+        return self.strace.point(range(self.draws)[idx])
+
+
 class MultiTrace(object):
     """Main interface for accessing values from MCMC results
 
@@ -169,6 +220,19 @@ class MultiTrace(object):
     def chains(self):
         return list(sorted(self._straces.keys()))
 
+    @property
+    def draws_per_chain(self):
+        """Number of draws of every chain, mapped to chain number."""
+        return {chain: len(strace) for chain, strace in self._straces.items()}
+
+    @property
+    def throughput(self):
+        """Draws per second of every chain, mapped to chain number. It is
+        None for chains that were not timed while sampling."""
+        return {chain: (len(strace) / strace.sampling_time
+                        if strace.sampling_time else None)
+                for chain, strace in self._straces.items()}
+
     def __getitem__(self, idx):
         if isinstance(idx, slice):
             return self._slice(idx)
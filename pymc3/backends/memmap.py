@@ -0,0 +1,171 @@
+"""Memory-mapped trace backend
+
+Store sampling values in NumPy arrays that are mapped to .npy files, one
+directory per chain. Draws are written in place, so the pages are shared
+between the process that samples a chain and the process that reads it,
+and pickling a trace (e.g. to return it from a worker process when
+`njobs` > 1) only sends the file names instead of the values.
+
+Placing the directory on a RAM-backed file system such as /dev/shm keeps
+the values in shared memory.
+"""
+import os
+import shutil
+from glob import glob
+from io import BytesIO
+
+import numpy as np
+from numpy.lib import format as npformat
+from numpy.lib.format import open_memmap
+
+from ..backends import base
+from ..backends.ndarray import NDArray
+
+
+class Memmap(NDArray):
+    """Memory-mapped trace object
+
+    Parameters
+    ----------
+    name : str
+        Name of directory to store the .npy files in. Each chain uses a
+        subdirectory, so the traces of all chains can be loaded together.
+        The directory is not removed by PyMC3.
+    model : Model
+        If None, the model is taken from the `with` context.
+    vars : list of variables
+        Sampling values will be stored for these variables. If None,
+        `model.unobserved_RVs` is used.
+    """
+    def __init__(self, name, model=None, vars=None):
+        super(Memmap, self).__init__(name, model, vars)
+
+    ## Sampling methods
+
+    def setup(self, draws, chain):
+        """Perform chain-specific setup.
+
+        Parameters
+        ----------
+        draws : int
+            Expected number of draws
+        chain : int
+            Chain number
+        """
+        if self.samples:
+            raise base.BackendError('Memmap traces can not be extended')
+        self.chain = chain
+        self.draws = draws
+        self.draw_idx = 0
+        chain_dir = os.path.join(self.name, 'chain-{}'.format(chain))
+        if not os.path.exists(chain_dir):
+            os.makedirs(chain_dir)
+        for varname, shape in self.var_shapes.items():
+            self.samples[varname] = open_memmap(
+                self._filename(varname), mode='w+',
+                dtype=self.var_dtypes[varname], shape=(draws, ) + shape)
+
+    def close(self):
+        for vtrace in self.samples.values():
+            vtrace.flush()
+        if self.draw_idx == self.draws:
+            return
+        ## Shorten the files if interrupted before completed all draws,
+        ## so that they are loaded with the recorded draws only.
+        self.samples = {}
+        for varname in self.varnames:
+            _truncate(self._filename(varname), self.draw_idx)
+        self.samples = {varname: _open(self._filename(varname))
+                        for varname in self.varnames}
+        self.draws = self.draw_idx
+
+    def _filename(self, varname):
+        return os.path.join(self.name, 'chain-{}'.format(self.chain),
+                            varname + '.npy')
+
+    ## Pickling maps the files again instead of copying their values.
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['samples'] = {}
+        state['_length'] = len(self)
+        return state
+
+    def __setstate__(self, state):
+        length = state.pop('_length')
+        self.__dict__.update(state)
+        if length:
+            self.samples = {varname: _open(self._filename(varname))[:length]
+                            for varname in self.varnames}
+
+
+def _open(filename):
+    return np.load(filename, mmap_mode='r+')
+
+
+def _truncate(filename, length):
+    """Keep the first `length` rows of the array in a .npy file."""
+    with open(filename, 'r+b') as fp:
+        version = npformat.read_magic(fp)
+        if version == (1, 0):
+            read, write = (npformat.read_array_header_1_0,
+                           npformat.write_array_header_1_0)
+        else:
+            read, write = (npformat.read_array_header_2_0,
+                           npformat.write_array_header_2_0)
+        shape, fortran_order, dtype = read(fp)
+        offset = fp.tell()
+
+        header = BytesIO()
+        write(header, {'descr': npformat.dtype_to_descr(dtype),
+                       'fortran_order': fortran_order,
+                       'shape': (length, ) + shape[1:]})
+        header = header.getvalue()
+        if len(header) == offset and not fortran_order:
+            # The rows are stored first, so the header is updated in place
+            # and the file cut after the last kept row.
+            fp.seek(0)
+            fp.write(header)
+            fp.truncate(offset + length * int(np.prod(shape[1:])) *
+                        dtype.itemsize)
+            return
+
+    values = np.array(np.load(filename, mmap_mode='r')[:length])
+    np.save(filename, values)
+
+
+def clear(name):
+    """Remove the chains stored in directory `name`.
+
+    Files of a chain that are still mapped stay valid until they are
+    closed, instead of being overwritten by a new chain with its number.
+    """
+    for d in glob(os.path.join(name, 'chain-*')):
+        shutil.rmtree(d)
+
+
+def load(name, model=None):
+    """Load Memmap database.
+
+    Parameters
+    ----------
+    name : str
+        Name of directory with one subdirectory of .npy files per chain
+    model : Model
+        If None, the model is taken from the `with` context.
+
+    Returns
+    -------
+    A MultiTrace instance
+    """
+    dirs = glob(os.path.join(name, 'chain-*'))
+
+    straces = []
+    for d in dirs:
+        strace = Memmap(name, model=model)
+        strace.chain = int(d.rsplit('-', 1)[1])
+        strace.samples = {varname: _open(strace._filename(varname))
+                          for varname in strace.varnames}
+        strace.draws = strace.draw_idx = len(strace)
+        straces.append(strace)
+    return base.MultiTrace(straces)
@@ -18,12 +18,19 @@ class NDArray(base.BaseTrace):
     vars : list of variables
         Sampling values will be stored for these variables. If None,
         `model.unobserved_RVs` is used.
+
+    If the `grow` attribute is set before `setup`, the arrays are grown as
+    draws are recorded instead of allocated for the expected number of
+    draws, for runs that are likely to stop earlier.
     """
+    grow_chunk = 1000
+
     def __init__(self, name=None, model=None, vars=None):
         super(NDArray, self).__init__(name, model, vars)
         self.draw_idx = 0
         self.draws = None
         self.samples = {}
+        self.grow = False
 
     ## Sampling methods
 
@@ -38,13 +45,14 @@ class NDArray(base.BaseTrace):
             Chain number
         """
         self.chain = chain
+        size = min(draws, self.grow_chunk) if self.grow else draws
         if self.samples:  # Concatenate new array if chain is already present.
             old_draws = len(self)
             self.draws = old_draws + draws
             self.draws_idx = old_draws
             for varname, shape in self.var_shapes.items():
                 old_var_samples = self.samples[varname]
-                new_var_samples = np.zeros((draws, ) + shape,
+                new_var_samples = np.zeros((size, ) + shape,
                                            self.var_dtypes[varname])
                 self.samples[varname] = np.concatenate((old_var_samples,
                                                         new_var_samples),
@@ -52,7 +60,7 @@ class NDArray(base.BaseTrace):
         else:  # Otherwise, make array of zeros for each variable.
             self.draws = draws
             for varname, shape in self.var_shapes.items():
-                self.samples[varname] = np.zeros((draws, ) + shape,
+                self.samples[varname] = np.zeros((size, ) + shape,
                                                  dtype=self.var_dtypes[varname])
 
     def record(self, point):
@@ -63,10 +71,20 @@ class NDArray(base.BaseTrace):
         point : dict
             Values mapped to variable names
         """
+        if self.grow and self.draw_idx == len(self):
+            self._grow()
         for varname, value in zip(self.varnames, self.fn(point)):
             self.samples[varname][self.draw_idx] = value
         self.draw_idx += 1
 
+    def _grow(self):
+        # Doubling keeps the cost of copying linear in the number of draws
+        size = min(self.draws, 2 * self.draw_idx)
+        for varname, values in self.samples.items():
+            grown = np.zeros((size, ) + values.shape[1:], values.dtype)
+            grown[:self.draw_idx] = values
+            self.samples[varname] = grown
+
     def close(self):
         if self.draw_idx == self.draws:
             return
@@ -6,7 +6,8 @@ Classes for working with subsets of parameters.
 import numpy as np
 import collections
 
-__all__ = ['ArrayOrdering', 'DictToArrayBijection', 'DictToVarBijection']
+__all__ = ['ArrayOrdering', 'DictToArrayBijection', 'DictToVarBijection',
+           'ArrayPoint']
 
 VarMap = collections.namedtuple('VarMap', 'var, slc, shp, dtyp')
 
@@ -81,6 +82,124 @@ class DictToArrayBijection(object):
         return Compose(f, self.rmap)
 
 
+class ArrayPoint(dict):
+    """
+    A point whose values are views into contiguous arrays, one for each
+    dtype
+
+    Step methods can read and write the values of their variables as a flat
+    array with `get_array` and `set_array`, instead of building a new point
+    on every step. `version` is increased on every write that changes a
+    value, so that step methods can tell whether the point has changed since
+    they last saw it.
+
+    Parameters
+    ----------
+    vars : list of variables
+    point : dict
+        Initial values
+    """
+    def __init__(self, vars, point):
+        super(ArrayPoint, self).__init__()
+        self.version = 0
+        self.data = {}
+        self.orderings = {}
+        self.slices = {}
+
+        dtypes = []
+        for var in vars:
+            if var.dtype not in dtypes:
+                dtypes.append(var.dtype)
+
+        for dtype in dtypes:
+            ordering = ArrayOrdering([var for var in vars if var.dtype == dtype])
+            data = np.empty(ordering.dimensions, dtype)
+            for var, slc, shp, _ in ordering.vmap:
+                value = data[slc].reshape(shp)
+                value[...] = point[var]
+                dict.__setitem__(self, var, value)
+            self.data[dtype] = data
+            self.orderings[dtype] = ordering
+
+    def __setitem__(self, var, value):
+        self[var][...] = value
+        self.version += 1
+
+    def update(self, *args, **kwargs):
+        for var, value in dict(*args, **kwargs).items():
+            self[var] = value
+
+    def __reduce__(self):
+        # views do not survive pickling, restore as a plain point
+        return (dict, (dict(self), ))
+
+    def get_array(self, ordering):
+        """
+        Flat float64 array of the values of the variables in `ordering`
+
+        Parameters
+        ----------
+        ordering : ArrayOrdering
+        """
+        slc = self.slice(ordering)
+        if slc is None:
+            return DictToArrayBijection(ordering, self).map(self)
+        return self.data['float64'][slc].copy()
+
+    def set_array(self, ordering, apt):
+        """
+        Write the values of the variables in `ordering` from a flat array
+
+        Parameters
+        ----------
+        ordering : ArrayOrdering
+        apt : array
+        """
+        slc = self.slice(ordering)
+        if slc is None:
+            apt = np.atleast_1d(apt)
+            changed = False
+            for var, slc, shp, _ in ordering.vmap:
+                value = self[var]
+                new_value = apt[slc].reshape(shp)
+                if not np.array_equal(value, new_value):
+                    value[...] = new_value
+                    changed = True
+        else:
+            data = self.data['float64'][slc]
+            changed = not np.array_equal(data, apt)
+            if changed:
+                data[...] = apt
+        # step methods that rejected their proposal leave the version as is
+        if changed:
+            self.version += 1
+
+    def slice(self, ordering):
+        """
+        Slice of the float64 data that holds the variables of `ordering` in
+        the same order, or None if they are not stored contiguously.
+        """
+        if ordering not in self.slices:
+            self.slices[ordering] = self._find_slice(ordering)
+        return self.slices[ordering]
+
+    def _find_slice(self, ordering):
+        if 'float64' not in self.orderings or not ordering.vmap:
+            return None
+        slcs = {var: slc for var, slc, _, _ in self.orderings['float64'].vmap}
+
+        start = stop = None
+        for var, _, _, dtype in ordering.vmap:
+            if dtype != 'float64' or var not in slcs:
+                return None
+            if start is None:
+                start = slcs[var].start
+            elif slcs[var].start != stop:
+                return None
+            stop = slcs[var].stop
+        return slice(start, stop)
+
+
 class DictToVarBijection(object):
     """
     A mapping between a dict space and the array space for one element within the dict space
@@ -87,7 +87,7 @@ def geweke(x, first=.1, last=.5, intervals=20):
         return np.array(zscores)
 
 
-def gelman_rubin(mtrace):
+def gelman_rubin(mtrace, varnames=None):
     """ Returns estimate of R for a set of traces.
 
     The Gelman-Rubin diagnostic tests for lack of convergence by comparing
@@ -102,6 +102,9 @@ def gelman_rubin(mtrace):
     mtrace : MultiTrace
       A MultiTrace object containing parallel traces (minimum 2)
       of one or more stochastic parameters.
+    varnames : list
+      Names of the variables to compute the diagnostic for. Defaults to all
+      variables in the trace.
 
     Returns
     -------
@@ -156,7 +159,10 @@ def gelman_rubin(mtrace):
             return np.squeeze([calc_rhat(xi) for xi in x.transpose(rotated_indices)])
 
     Rhat = {}
-    for var in mtrace.varnames:
+    if varnames is None:
+        varnames = mtrace.varnames
+
+    for var in varnames:
 
         # Get all traces for var
         x = np.array(mtrace.get_values(var, combine=False))
@@ -169,7 +175,7 @@ def gelman_rubin(mtrace):
     return Rhat
 
 
-def effective_n(mtrace):
+def effective_n(mtrace, varnames=None):
     """ Returns estimate of the effective sample size of a set of traces.
 
     Parameters
@@ -177,6 +183,9 @@ def effective_n(mtrace):
     mtrace : MultiTrace
       A MultiTrace object containing parallel traces (minimum 2)
       of one or more stochastic parameters.
+    varnames : list
+      Names of the variables to compute the diagnostic for. Defaults to all
+      variables in the trace.
     
     Returns
     -------
@@ -236,8 +245,7 @@ def effective_n(mtrace):
         
         Vhat = calc_vhat(x)
         
-        variogram = lambda t: (sum(sum((x[j][i] - x[j][i-t])**2 
-                            for i in range(t,n)) for j in range(m)) / (m*(n - t)))
+        variogram = lambda t: np.mean((x[:, t:] - x[:, :n - t])**2)
         
         rho = np.ones(n)
         # Iterate until the sum of consecutive estimates of autocorrelation is negative
@@ -253,7 +261,10 @@ def effective_n(mtrace):
         return int(m*n / (1. + 2*rho[1:t].sum()))
     
     n_eff = {}
-    for var in mtrace.varnames:
+    if varnames is None:
+        varnames = mtrace.varnames
+
+    for var in varnames:
 
         # Get all traces for var
         x = np.array(mtrace.get_values(var, combine=False))
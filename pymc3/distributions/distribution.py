@@ -13,6 +13,9 @@ __all__ = ['DensityDist', 'Distribution', 'Continuous', 'Discrete', 'NoDistribut
 class Distribution(object):
     """Statistical distribution"""
     def __new__(cls, name, *args, **kwargs):
+        if name is None:
+            return object.__new__(cls)  # for pickle
+
         try:
             model = Model.get_context()
         except TypeError:
@@ -24,8 +27,6 @@ class Distribution(object):
             data = kwargs.pop('observed', None)
             dist = cls.dist(*args, **kwargs)
             return model.Var(name, dist, data)
-        elif name is None:
-            return object.__new__(cls)  # for pickle
         else:
             raise TypeError("needed name or None but got: %s" % name)
 
@@ -4,13 +4,14 @@ import theano.tensor as tt
 from theano.tensor.var import TensorVariable
 
 from .memoize import memoize
-from .theanof import gradient, hessian, inputvars
+from .theanof import (gradient, hessian, inputvars, join_nonshared_inputs,
+                      make_shared_replacements)
 from .vartypes import typefilter, discrete_types, continuous_types
 from .blocking import DictToArrayBijection, ArrayOrdering
 
 __all__ = [
     'Model', 'Factor', 'compilef', 'fn', 'fastfn', 'modelcontext',
-    'Point', 'Deterministic', 'Potential'
+    'Point', 'Deterministic', 'Potential', 'ValueGradFunction'
 ]
 
 
@@ -213,6 +214,39 @@ class Model(Context, Factor):
         vars = inputvars(self.cont_vars)
         return self.bijection.mapf(self.fastdlogp(vars))
 
+    def logp_dlogp_function(self, vars=None, shared=None, grad=True,
+                            conditional=False, **kwargs):
+        """Compiles a Theano function which returns the log-probability and
+        its gradient and takes the values of `vars` as one flat float64 array.
+
+        Parameters
+        ----------
+        vars : list of free variables
+            Variables in the flat array, in this order (defaults to
+            continuous variables)
+        shared : dict of theano variable -> shared variable
+            Replacements for the other model variables. Defaults to new
+            shared variables, see `make_shared_replacements`.
+        grad : bool
+            If False only the log-probability is computed and returned
+        conditional : bool
+            If True only the factors that depend on `vars` are included, see
+            `conditional_logpt`
+
+        Returns
+        -------
+        ValueGradFunction
+            A new instance on every call, since its shared variables are
+            set by the caller.
+        """
+        # The order of vars is kept, it defines the layout of the array
+        if vars is None:
+            vars = self.cont_vars
+        if shared is None:
+            shared = make_shared_replacements(vars, self)
+        cost = self.conditional_logpt(vars) if conditional else self.logpt
+        return ValueGradFunction(cost, vars, shared, grad, **kwargs)
+
     @property
     @memoize
     def logpt(self):
@@ -227,6 +261,18 @@ class Model(Context, Factor):
         factors = [var.logpt for var in self.vars]
         return tt.add(*map(tt.sum, factors))
 
+    def conditional_logpt(self, vars):
+        """Theano scalar of the log-probability of `vars` given their Markov
+        blanket, up to a constant. Only the factors of the model that depend
+        on `vars` are included."""
+        vars = set(inputvars(vars))
+        factors = [var.logpt for var in self.basic_RVs] + self.potentials
+        factors = [factor for factor in factors
+                   if vars.intersection(theano.gof.graph.inputs([factor]))]
+        if not factors:
+            return tt.constant(0.)
+        return tt.add(*map(tt.sum, factors))
+
     @property
     def vars(self):
         """List of unobserved random variables used as inputs to the model
@@ -480,6 +526,69 @@ class LoosePointFunc(object):
         point = Point(model=self.model, *args, **kwargs)
         return self.f(**point)
 
+class ValueGradFunction(object):
+    """Compiled function of a flat float64 array that returns a cost and
+    its gradient.
+
+    The function is compiled with `trust_input`, so it has to be called with
+    a contiguous float64 vector of the right size. The other model variables
+    are bound to shared variables which are set with `set_point`.
+
+    Parameters
+    ----------
+    cost : scalar theano variable
+    vars : list of variables the flat array is mapped to
+    shared : dict of theano variable -> shared variable
+    grad : bool
+        If False only the cost is computed and returned
+    **kwargs
+        Compilation args
+    """
+    def __init__(self, cost, vars, shared, grad=True, **kwargs):
+        self.vars = vars
+        self.ordering = ArrayOrdering(vars)
+        self.shared = {str(var): shared for var, shared in shared.items()}
+        self.grad = grad
+
+        outs = [cost, gradient(cost, vars)] if grad else [cost]
+        if not vars:
+            inarray = tt.dvector('x')
+            inarray.tag.test_value = np.zeros(0)
+            outs = theano.clone(outs, shared, strict=False)
+            kwargs.setdefault('on_unused_input', 'ignore')
+        else:
+            outs, inarray = join_nonshared_inputs(outs, vars, shared)
+        if inarray.dtype != 'float64':
+            x = tt.dvector('x')
+            x.tag.test_value = inarray.tag.test_value.astype('float64')
+            cast = tt.patternbroadcast(x.astype(inarray.dtype),
+                                       inarray.broadcastable)
+            outs = theano.clone(outs, {inarray: cast})
+            inarray = x
+
+        self.f = theano.function([inarray], outs if grad else outs[0], **kwargs)
+        self.f.trust_input = True
+
+    @property
+    def size(self):
+        return self.ordering.dimensions
+
+    def set_point(self, point):
+        """Set the values of the shared variables from a point."""
+        for var, share in self.shared.items():
+            share.container.storage[0] = point[var]
+
+    def dict_to_array(self, point):
+        return DictToArrayBijection(self.ordering, point).map(point)
+
+    def array_to_dict(self, array, point):
+        """Return a copy of `point` with the values of `vars` from `array`."""
+        return DictToArrayBijection(self.ordering, point).rmap(array)
+
+    def __call__(self, array):
+        return self.f(array)
+
+
 compilef = fastfn
 
 
@@ -1,24 +1,34 @@
 from . import backends
-from .backends.base import merge_traces, BaseTrace, MultiTrace
+from .backends.base import merge_traces, BaseTrace, MultiTrace, TraceView
 from .backends.ndarray import NDArray
+from .backends import memmap
 from joblib import Parallel, delayed
 from time import time
 from .model import modelcontext, Point
+from .blocking import ArrayPoint
 from .step_methods import (NUTS, HamiltonianMC, Metropolis, BinaryMetropolis,
-                         BinaryGibbsMetropolis, Slice, ElemwiseCategorical, CompoundStep)
+                         BinaryGibbsMetropolis, Slice, ElemwiseCategorical,
+                         ConjugateGibbs, CompoundStep)
 from .progressbar import progress_bar
+from .diagnostics import effective_n, gelman_rubin
 from numpy.random import randint, seed
 from numpy import shape, append, asarray
+import numpy as np
 from collections import defaultdict
 
+import hashlib
+import multiprocessing as mp
+import pickle
 import sys
+import warnings
 sys.setrecursionlimit(10000)
 
-__all__ = ['sample', 'iter_sample', 'sample_ppc']
+__all__ = ['sample', 'iter_sample', 'sample_until_converged', 'sample_ppc',
+           'SamplingPool']
 
 def assign_step_methods(model, step=None,
-        methods=(NUTS, HamiltonianMC, Metropolis, BinaryMetropolis, BinaryGibbsMetropolis,
-        Slice, ElemwiseCategorical)):
+        methods=(ConjugateGibbs, NUTS, HamiltonianMC, Metropolis, BinaryMetropolis,
+        BinaryGibbsMetropolis, Slice, ElemwiseCategorical)):
     '''
     Assign model variables to appropriate step methods. Passing a specified
     model will auto-assign its constituent stochastic variables to step methods
@@ -38,8 +48,9 @@ def assign_step_methods(model, step=None,
         One or more step functions that have been assigned to some subset of
         the model's parameters. Defaults to None (no assigned variables).
     methods : vector of step method classes
-        The set of step methods from which the function may choose. Defaults
-        to the main step methods provided by PyMC3.
+        The set of step methods from which the function may choose, in order
+        of preference among equally competent methods. Defaults to the main
+        step methods provided by PyMC3.
 
     Returns
     -------
@@ -64,7 +75,8 @@ def assign_step_methods(model, step=None,
 
             competences = {s:s._competence(var) for s in methods}
 
-            selected = max(competences.keys(), key=(lambda k: competences[k]))
+            # Ties go to the method listed first
+            selected = max(methods, key=(lambda k: competences[k]))
 
             if model.verbose:
                 print('Assigned {0} to {1}'.format(selected.__name__, var))
@@ -79,7 +91,8 @@ def assign_step_methods(model, step=None,
     return steps
 
 def sample(draws, step=None, start=None, trace=None, chain=0, njobs=1, tune=None,
-           progressbar=True, model=None, random_seed=None):
+           progressbar=True, model=None, random_seed=None, pool=None,
+           time_budget=None, tune_budget=None):
     """
     Draw a number of samples using the given step method.
     Multiple step methods supported via compound step method
@@ -105,7 +118,10 @@ def sample(draws, step=None, start=None, trace=None, chain=0, njobs=1, tune=None
         If None or a list of variables, the NDArray backend is used.
         Passing either "text" or "sqlite" is taken as a shortcut to set
         up the corresponding backend (with "mcmc" used as the base
-        name).
+        name). Passing "memmap" stores the values in memory-mapped files
+        in the directory "mcmc-memmap", which avoids copying them back
+        from the worker processes when `njobs` > 1. The files are kept
+        after sampling and removed by the next run with this shortcut.
     chain : int
         Chain number used to store sample in backend. If `njobs` is
         greater than one, chain numbers will start here.
@@ -119,6 +135,20 @@ def sample(draws, step=None, start=None, trace=None, chain=0, njobs=1, tune=None
     model : Model (optional if in `with` context)
     random_seed : int or list of ints
         A list is accepted if more if `njobs` is greater than one.
+    pool : SamplingPool
+        Worker processes that sample the chains if `njobs` is greater than
+        one, and are kept running for later calls. If None, new processes
+        are started with joblib.
+    time_budget : float
+        Seconds of wall-clock time after which all chains stop, with fewer
+        than `draws` samples if they have not finished. The number of draws
+        and the draws per second of every chain are given by the
+        `draws_per_chain` and `throughput` attributes of the result. The
+        arrays of the NDArray backend grow with the draws instead of being
+        allocated for `draws`, so that `draws` can be set high.
+    tune_budget : float
+        Seconds of wall-clock time after which tuning stops, if it has not
+        stopped after `tune` iterations.
 
     Returns
     -------
@@ -129,9 +159,10 @@ def sample(draws, step=None, start=None, trace=None, chain=0, njobs=1, tune=None
     step = assign_step_methods(model, step)
 
     if njobs is None:
-        import multiprocessing as mp
         njobs = max(mp.cpu_count() - 2, 1)
 
+    _clear_shortcut(trace)
+
     sample_args = {'draws':draws, 
                     'step':step, 
                     'start':start, 
@@ -140,10 +171,12 @@ def sample(draws, step=None, start=None, trace=None, chain=0, njobs=1, tune=None
                     'tune':tune, 
                     'progressbar':progressbar, 
                     'model':model, 
-                    'random_seed':random_seed}
+                    'random_seed':random_seed,
+                    'deadline':_deadline(time_budget),
+                    'tune_deadline':_deadline(tune_budget)}
                
     if njobs>1:
-        sample_func = _mp_sample
+        sample_func = _mp_sample if pool is None else pool.sample
         sample_args['njobs'] = njobs
     else:
         sample_func = _sample
@@ -152,9 +185,10 @@ def sample(draws, step=None, start=None, trace=None, chain=0, njobs=1, tune=None
 
 
 def _sample(draws, step=None, start=None, trace=None, chain=0, tune=None,
-            progressbar=True, model=None, random_seed=None):
+            progressbar=True, model=None, random_seed=None, deadline=None,
+            tune_deadline=None):
     sampling = _iter_sample(draws, step, start, trace, chain,
-                            tune, model, random_seed)
+                            tune, model, random_seed, deadline, tune_deadline)
     progress = progress_bar(draws)
     try:
         for i, strace in enumerate(sampling):
@@ -166,12 +200,18 @@ def _sample(draws, step=None, start=None, trace=None, chain=0, tune=None,
 
 
 def iter_sample(draws, step, start=None, trace=None, chain=0, tune=None,
-                model=None, random_seed=None):
+                model=None, random_seed=None, time_budget=None,
+                tune_budget=None):
     """
     Generator that returns a trace on each iteration using the given
     step method.  Multiple step methods supported via compound step
     method returns the amount of time taken.
 
+    The same trace is returned on every iteration. It is a read-only view
+    of the draws so far, which grows as draws are recorded, so that every
+    iteration takes constant time. Slice it, as in `trace[:]`, to keep a
+    copy.
+
 
     Parameters
     ----------
@@ -197,6 +237,12 @@ def iter_sample(draws, step, start=None, trace=None, chain=0, tune=None,
     model : Model (optional if in `with` context)
     random_seed : int or list of ints
         A list is accepted if more if `njobs` is greater than one.
+    time_budget : float
+        Seconds of wall-clock time after which the generator stops, with
+        fewer than `draws` samples if it has not finished.
+    tune_budget : float
+        Seconds of wall-clock time after which tuning stops, if it has not
+        stopped after `tune` iterations.
 
     Example
     -------
@@ -204,14 +250,21 @@ def iter_sample(draws, step, start=None, trace=None, chain=0, tune=None,
     for trace in iter_sample(500, step):
         ...
     """
+    _clear_shortcut(trace)
     sampling = _iter_sample(draws, step, start, trace, chain, tune,
-                            model, random_seed)
+                            model, random_seed, _deadline(time_budget),
+                            _deadline(tune_budget))
     for i, strace in enumerate(sampling):
-        yield MultiTrace([strace[:i + 1]])
+        if i == 0:
+            view = TraceView(strace)
+            mtrace = MultiTrace([view])
+        view.draws = i + 1
+        yield mtrace
 
 
 def _iter_sample(draws, step, start=None, trace=None, chain=0, tune=None,
-                 model=None, random_seed=None):
+                 model=None, random_seed=None, deadline=None,
+                 tune_deadline=None):
     model = modelcontext(model)
     draws = int(draws)
     seed(random_seed)
@@ -233,17 +286,279 @@ def _iter_sample(draws, step, start=None, trace=None, chain=0, tune=None,
     except TypeError:
         pass
 
-    point = Point(start, model=model)
+    set_tuning(step, tune)
 
+    # Step methods update the values of their variables in place
+    point = ArrayPoint(model.vars, Point(start, model=model))
+
+    if deadline is not None and isinstance(strace, NDArray):
+        # Most of `draws` may not be taken before the deadline
+        strace.grow = True
     strace.setup(draws, chain)
+    start_time = time()
+    tuning = True
     for i in range(draws):
-        if i == tune:
+        if tuning and (i == tune or
+                       tune_deadline is not None and time() > tune_deadline):
             step = stop_tuning(step)
+            tuning = False
         point = step.step(point)
         strace.record(point)
+        now = time()
+        strace.sampling_time = now - start_time
         yield strace
-    else:
+        if deadline is not None and now > deadline:
+            break
+    strace.close()
+
+
+def _deadline(budget):
+    """Wall-clock time `budget` seconds from now, or None."""
+    if budget is None:
+        return None
+    return time() + budget
+
+
+def sample_until_converged(max_draws, step=None, chunk=500, rhat=1.1,
+                           n_eff=200, varnames=None, nchains=2, start=None,
+                           trace=None, tune=None, progressbar=True, model=None,
+                           random_seed=None, njobs=1, pool=None):
+    """
+    Draw samples from several chains in chunks, until the Gelman-Rubin
+    statistic and the effective sample size of every monitored variable meet
+    their targets or `max_draws` draws have been taken in every chain.
+
+    The chains are advanced in lockstep, each with its own copy of the step
+    methods, and the diagnostics are computed after every chunk on the draws
+    after tuning. The effective sample size is only computed once all
+    Gelman-Rubin statistics meet their target. The chains are sampled in
+    parallel if `njobs` is greater than one or a pool is given.
+
+    Parameters
+    ----------
+
+    max_draws : int
+        The largest number of samples to draw in every chain
+    step : function or iterable of functions
+        A step function or collection of functions. If no step methods are
+        specified, or are partially specified, they will be assigned
+        automatically (defaults to None).
+    chunk : int
+        Number of samples drawn in every chain between convergence checks
+    rhat : float or dict
+        Upper bound on the Gelman-Rubin statistic, or bounds mapped to
+        variable names
+    n_eff : float or dict
+        Lower bound on the effective sample size, or bounds mapped to
+        variable names
+    varnames : list
+        Names of the variables to monitor. Defaults to all variables in the
+        trace.
+    nchains : int
+        Number of chains (minimum 2)
+    start : dict or list of dicts
+        Starting point in parameter space (or partial point), or one per
+        chain. Defaults to model.test_point.
+    trace : str or list
+        The name of a backend ('text', 'sqlite' or 'memmap'), a list of
+        variables to track or None. If None or a list of variables, the
+        NDArray backend is used.
+    tune : int
+        Number of iterations to tune, if applicable (defaults to None). The
+        tuning samples are left out of the diagnostics.
+    progressbar : bool
+        Flag for progress bar
+    model : Model (optional if in `with` context)
+    random_seed : int
+        Random seed
+    njobs : int
+        Number of worker processes started for the chains, if no pool is
+        given. If None, set to number of cpus in the system - 2.
+    pool : SamplingPool
+        Worker processes to sample the chains in
+
+    Returns
+    -------
+    MultiTrace object with the samples of every chain, including the tuning
+    samples. If sampling is interrupted, the chains are cut to the chunks
+    that all chains have finished and kept in NDArray backends.
+    """
+    model = modelcontext(model)
+    if nchains < 2:
+        raise ValueError('Argument `nchains` should be at least 2.')
+    if isinstance(trace, (BaseTrace, MultiTrace)):
+        raise ValueError('Pass a backend name or a list of variables to '
+                         'record every chain')
+    if njobs is None:
+        njobs = max(mp.cpu_count() - 2, 1)
+
+    _clear_shortcut(trace)
+    step = assign_step_methods(model, step)
+    seed(random_seed)
+    start_vals = _make_parallel(start, nchains)
+    rseeds = randint(2 ** 30, size=nchains)
+    chain_args = [dict(draws=max_draws, start=start_vals[c], trace=trace,
+                       chain=c, tune=tune, random_seed=rseeds[c])
+                  for c in range(nchains)]
+
+    # Values of the finished chunks of every chain
+    vars = None if trace is None or isinstance(trace, str) else trace
+    samples = [defaultdict(list) for _ in range(nchains)]
+    burn = tune or 0
+
+    progress = progress_bar(max_draws)
+    draws = 0
+    own_pool = pool is None and njobs > 1
+    if own_pool:
+        pool = SamplingPool(min(njobs, nchains))
+    try:
+        if pool is None:
+            chains = _LocalChains(step, model, chain_args)
+        else:
+            chains = _PoolChains(pool, step, model, chain_args)
+        try:
+            while draws < max_draws:
+                n = min(chunk, max_draws - draws)
+                for c, values in enumerate(chains.advance(n)):
+                    for varname, value in values.items():
+                        samples[c][varname].append(value)
+                draws += n
+                if progressbar:
+                    progress.update(draws - 1)
+
+                if draws - burn > 1:
+                    mtrace = _chunks_trace(samples, model, vars)[burn:]
+                    if _converged(mtrace, varnames or mtrace.varnames,
+                                  rhat, n_eff):
+                        break
+            else:
+                warnings.warn('The convergence targets were not met in '
+                              '{} draws'.format(max_draws))
+            mtrace = MultiTrace(chains.finish())
+        except KeyboardInterrupt:
+            chains.stop()
+            if not draws:
+                raise
+            mtrace = _chunks_trace(samples, model, vars)
+        except BaseException:
+            chains.stop()
+            raise
+    finally:
+        if own_pool:
+            pool.close()
+    return mtrace
+
+
+def _chunks_trace(samples, model, vars):
+    """MultiTrace of NDArray backends with the chunks of every chain."""
+    straces = []
+    for chain, chunks in enumerate(samples):
+        strace = NDArray(model=model, vars=vars)
+        strace.chain = chain
+        strace.samples = {varname: np.concatenate(values)
+                          for varname, values in chunks.items()}
+        strace.draws = strace.draw_idx = len(strace)
+        straces.append(strace)
+    return MultiTrace(straces)
+
+
+def _sample_chunks(step, model, **kwargs):
+    """
+    Generator that samples a chain in chunks of the sizes that are sent to
+    it, and yields the values of the draws of every chunk. Sending 0 stops
+    the chain and yields its trace.
+    """
+    sampler = _iter_sample(step=step, model=model, **kwargs)
+    strace = None
+    idx = 0
+    n = yield
+    while n:
+        for _ in range(n):
+            strace = next(sampler)
+        values = {varname: np.array(strace.get_values(varname)[idx:idx + n])
+                  for varname in strace.varnames}
+        idx += n
+        n = yield values
+    sampler.close()
+    if strace is not None:
         strace.close()
+    yield strace
+
+
+class _LocalChains(object):
+    """Chains sampled in chunks in this process, the first one with `step`
+    and the others with copies."""
+    def __init__(self, step, model, chain_args):
+        steps = [step] + [pickle.loads(pickle.dumps(step, -1))
+                          for _ in chain_args[1:]]
+        self.chains = [_sample_chunks(s, model, **args)
+                       for s, args in zip(steps, chain_args)]
+        for chain in self.chains:
+            next(chain)
+
+    def advance(self, n):
+        return [chain.send(n) for chain in self.chains]
+
+    def finish(self):
+        return [chain.send(0) for chain in self.chains]
+
+    def stop(self):
+        for chain in self.chains:
+            chain.close()
+
+
+class _PoolChains(object):
+    """Chains sampled in chunks by the workers of a pool."""
+    def __init__(self, pool, step, model, chain_args):
+        self.pool = pool
+        self.workers = [c % len(pool.conns) for c in range(len(chain_args))]
+        jobs = []
+        payload = pickle.dumps((step, model), -1)
+        for worker, args in zip(self.workers, chain_args):
+            jobs.extend(pool._load(worker, payload))
+            jobs.append((worker, 'start', args))
+        try:
+            pool._run(jobs)
+        except Exception:
+            self.stop()
+            raise
+
+    def advance(self, n):
+        return self.pool._run([(worker, 'chunk', (c, n))
+                               for c, worker in enumerate(self.workers)])
+
+    def finish(self):
+        return self.advance(0)
+
+    def stop(self):
+        # Drop the chains held by the workers
+        if self.pool.procs:
+            self.pool._restart()
+
+
+def _converged(mtrace, varnames, rhat, n_eff):
+    Rhat = gelman_rubin(mtrace, varnames)
+    if not all(np.all(np.asarray(Rhat[v]) < _target(rhat, v, np.inf))
+               for v in varnames):
+        return False
+    neff = effective_n(mtrace, varnames)
+    return all(np.all(np.asarray(neff[v]) >= _target(n_eff, v, 0))
+               for v in varnames)
+
+
+def _target(target, varname, default):
+    """Bound for `varname`, where variables left out of a dict of bounds
+    get `default`."""
+    if isinstance(target, dict):
+        return target.get(varname, default)
+    return target
+
+
+def _clear_shortcut(trace):
+    """Remove the chains of an earlier run from the directory of the
+    "memmap" shortcut, so that they are not loaded with the new chains."""
+    if isinstance(trace, str) and trace == 'memmap':
+        memmap.clear(backends._shortcuts['memmap']['name'])
 
 
 def _choose_backend(trace, chain, shortcuts=None, **kwds):
@@ -290,6 +605,171 @@ def _mp_sample(**kwargs):
     return merge_traces(traces)
 
 
+class SamplingPool(object):
+    """
+    Worker processes that sample chains, started once and reused by every
+    call of `sample` that is given the pool.
+
+    The pickled model and step methods are sent to each worker once, the
+    first time the worker samples a chain with them, instead of with every
+    chain. The workers keep the pickled bytes and load a new copy of the
+    step methods for every chain, so that every chain starts from the
+    state of the step methods in the calling process, as with `njobs`
+    without a pool. Changed step methods are sent again.
+
+    Parameters
+    ----------
+    njobs : int
+        Number of worker processes. If None, set to number of cpus in the
+        system - 2.
+
+    Example
+    -------
+
+    with SamplingPool(4) as pool:
+        trace = sample(1000, step, njobs=4, pool=pool)
+        ...
+    """
+    def __init__(self, njobs=None):
+        if njobs is None:
+            njobs = max(mp.cpu_count() - 2, 1)
+        self.njobs = njobs
+        self._start()
+
+    def _start(self):
+        self.conns = []
+        self.procs = []
+        for i in range(self.njobs):
+            conn, child_conn = mp.Pipe()
+            proc = mp.Process(target=_pool_worker, args=(child_conn,))
+            proc.daemon = True
+            proc.start()
+            # Only the worker holds its end, so that its exit closes the pipe
+            child_conn.close()
+            self.conns.append(conn)
+            self.procs.append(proc)
+        # Digest of the step methods loaded by every worker
+        self.loaded = [None] * self.njobs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stop the worker processes."""
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (IOError, OSError):  # the worker has stopped
+                pass
+        for proc in self.procs:
+            proc.join()
+        self.conns = []
+        self.procs = []
+
+    def _restart(self):
+        """Replace the workers, dropping the chains they are sampling."""
+        for proc in self.procs:
+            proc.terminate()
+        for proc, conn in zip(self.procs, self.conns):
+            proc.join()
+            conn.close()
+        self._start()
+
+    def sample(self, njobs, chain, random_seed, start, step, model, **kwargs):
+        """
+        Sample `njobs` chains, numbered from `chain`, in the workers. Takes
+        the arguments of `sample`.
+        """
+        payload = pickle.dumps((step, model), -1)
+        rseed = _make_parallel(random_seed, njobs)
+        start_vals = _make_parallel(start, njobs)
+        pbars = [kwargs.pop('progressbar')] + [False] * (njobs - 1)
+
+        jobs = []
+        for i in range(njobs):
+            worker = i % len(self.conns)
+            jobs.extend(self._load(worker, payload))
+            jobs.append((worker, 'sample', dict(
+                kwargs, chain=chain + i, progressbar=pbars[i],
+                random_seed=rseed[i], start=start_vals[i])))
+        return merge_traces(self._run(jobs))
+
+    def _load(self, worker, payload):
+        """The job that sends the pickled step methods and model to
+        `worker`, unless it has them."""
+        key = hashlib.sha1(payload).hexdigest()
+        if self.loaded[worker] == key:
+            return []
+        self.loaded[worker] = key
+        return [(worker, 'load', payload)]
+
+    def _run(self, jobs):
+        """
+        Send the (worker, action, args) jobs and return the replies of the
+        workers in the same order, raising the errors of the workers.
+        """
+        try:
+            for worker, action, args in jobs:
+                self.conns[worker].send((action, args))
+            replies = [self.conns[worker].recv()
+                       for worker, action, args in jobs if action != 'load']
+        except (EOFError, IOError, OSError):
+            self.close()
+            raise RuntimeError('A worker process of the pool stopped, '
+                               'the pool has been closed')
+        except BaseException:
+            # Unread replies would be taken as the results of the next call
+            self._restart()
+            raise
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+
+
+def _pool_worker(conn):
+    payload = None
+    # Chains sampled in chunks, see `sample_until_converged`
+    chains = {}
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        action, args = msg
+        if action == 'load':
+            payload = args
+            continue
+        try:
+            if action == 'sample':
+                step, model = pickle.loads(payload)
+                reply = _sample(step=step, model=model, **args)
+            elif action == 'start':
+                step, model = pickle.loads(payload)
+                chains[args['chain']] = _sample_chunks(step, model, **args)
+                reply = next(chains[args['chain']])
+            else:
+                chain, n = args
+                reply = chains[chain].send(n)
+                if not n:
+                    del chains[chain]
+        except Exception as e:
+            reply = e
+        conn.send(reply)
+
+
+def set_tuning(step, tune):
+    """ tell the step methods the number of tuning iterations """
+
+    if hasattr(step, 'set_tuning'):
+        step.set_tuning(tune)
+
+    elif hasattr(step, 'methods'):
+        for s in step.methods:
+            set_tuning(s, tune)
+
 def stop_tuning(step):
     """ stop tuning the current step method """
 
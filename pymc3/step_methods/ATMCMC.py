@@ -10,15 +10,18 @@ from ..model import modelcontext, Point
 from ..theanof import inputvars
 from ..vartypes import discrete_types
 from ..step_methods import metropolis
-from ..blocking import DictToArrayBijection
-from ..backends import Text
+from ..blocking import DictToArrayBijection, ArrayPoint
+from ..backends import text
 from ..backends.base import merge_traces, BaseTrace, MultiTrace
 from ..backends.ndarray import NDArray
 from .. import backends
 from ..progressbar import progress_bar
 
 import os
+import threading
 import theano
+import theano.tensor as tt
+from theano.ifelse import ifelse
 
 from ..theanof import make_shared_replacements, join_nonshared_inputs
 from ..step_methods.metropolis import MultivariateNormalProposal as MvNPd
@@ -66,6 +69,23 @@ class ATMCMC(ArrayStepShared):
                   check if current sample lies outside of variable definition
                   speeds up computation as the forward model wont be executed
                   default: True
+    surrogate : GPSurrogate
+                emulator of the likelihood, fitted to the end points of the
+                chains after every stage. The log-probability of a sample is
+                approximated by the prior plus the emulated likelihood, so
+                the likelihood has to be the only other term of the model.
+                default: None
+    surrogate_mode : string
+                     'screen' rejects samples on the approximation first and
+                     runs the forward model only for samples that pass, which
+                     leaves the sampled distribution exact.
+                     'replace' uses the approximation instead of the forward
+                     model wherever its predictive standard deviation is
+                     below surrogate.tol. Emulated values only enter the
+                     acceptance of the following proposals, the cached exact
+                     logp and the likelihoods of the resampling weights are
+                     always computed with the forward model.
+                     default: 'screen'
     model : PyMC Model
         Optional model for sampling step.
         Defaults to None (taken from context).
@@ -75,7 +95,8 @@ class ATMCMC(ArrayStepShared):
     def __init__(self, vars=None, covariance=None, scaling=1., n_chains=100,
                  tune=True, tune_interval=100, model=None, check_bound=True,
                  likelihood_name='like', proposal_dist=MvNPd,
-                 coef_variation=1., **kwargs):
+                 coef_variation=1., surrogate=None, surrogate_mode='screen',
+                 **kwargs):
 
         model = modelcontext(model)
 
@@ -87,7 +108,7 @@ class ATMCMC(ArrayStepShared):
             self.covariance = np.eye(sum(v.dsize for v in vars))
         self.scaling = np.atleast_1d(scaling)
         self.tune = tune
-        self.check_bnd = check_bound
+        self.check_bound = check_bound
         self.tune_interval = tune_interval
         self.steps_until_tune = tune_interval
 
@@ -102,7 +123,20 @@ class ATMCMC(ArrayStepShared):
         self.coef_variation = coef_variation
         self.n_chains = n_chains
         self.likelihoods = []
+        if surrogate_mode not in ('screen', 'replace'):
+            raise ValueError("surrogate_mode has to be 'screen' or 'replace'")
+        self.surrogate = surrogate
+        self.surrogate_mode = surrogate_mode
         self.likelihood_name = likelihood_name
+        likelihood = [v for v in model.deterministics
+                      if v.name == likelihood_name]
+        if not likelihood:
+            raise ValueError('Model (deterministic) variables need to contain '
+                             'a variable `' + likelihood_name + '` as '
+                             'defined by `likelihood_name`.')
+        self.likelihood_var = likelihood[0]
+        self.likelihood = model.fastfn(likelihood[0])
+        self.population_fn = None
         self.discrete = np.concatenate(
             [[v.dtype in discrete_types] * (v.dsize or 1) for v in vars])
         self.any_discrete = self.discrete.any()
@@ -119,15 +153,25 @@ class ATMCMC(ArrayStepShared):
         shared = make_shared_replacements(vars, model)
         self.logp_forw = logp_forw(model.logpt, vars, shared)
         self.check_bnd = logp_forw(model.varlogpt, vars, shared)
-        self.delta_logp = metropolis.delta_logp(model.logpt, vars, shared)
+        # logp of the current state, reused until the point changes, and
+        # its approximation by the surrogate. logp0 is None when only the
+        # approximation of the current state is known.
+        self.logp0 = None
+        self.approx_logp0 = None
 
         super(ATMCMC, self).__init__(vars, shared)
 
     def astep(self, q0):
         if self.stage == 0:
-            self.likelihoods.append(self.logp_forw(q0))
+            self.logp0 = self.logp_forw(q0)
+            self.likelihoods.append(self.logp0)
             q_new = q0
         else:
+            if self.point_changed or (self.logp0 is None and
+                                      self.approx_logp0 is None):
+                self.logp0 = self.logp_forw(q0)
+                self.approx_logp0 = None
+
             if not self.stage_sample:
                 self.proposal_samples_array = self.proposal_dist(self.n_steps)
 
@@ -155,20 +199,20 @@ class ATMCMC(ArrayStepShared):
             else:
                 q = q0 + delta
 
-            if self.check_bnd:
-                varlogp = self.check_bnd(q)
-                if np.isfinite(varlogp):
-                    q_new = metropolis.metrop_select(
-                                    self.beta * self.delta_logp(q, q0), q, q0)
-                    if q_new is q:
-                        self.accepted += 1
-                else:
-                    q_new = q0
+            if self.check_bound and not np.isfinite(self.check_bnd(q)):
+                q_new = q0
+            elif self.surrogate is not None and self.surrogate.fitted:
+                q_new = self.surrogate_select(q, q0)
             else:
+                if self.logp0 is None:
+                    self.logp0 = self.logp_forw(q0)
+                logp = self.logp_forw(q)
                 q_new = metropolis.metrop_select(
-                                self.beta * self.delta_logp(q, q0), q, q0)
+                                self.beta * (logp - self.logp0), q, q0)
                 if q_new is q:
                     self.accepted += 1
+                    self.logp0 = logp
+                    self.approx_logp0 = None
 
             self.steps_until_tune -= 1
             self.stage_sample += 1
@@ -179,6 +223,79 @@ class ATMCMC(ArrayStepShared):
 
         return q_new
 
+    def approx_logp(self, q):
+        """Approximate logp at q from the prior and the emulated likelihood."""
+        return self.check_bnd(q) + self.surrogate.predict(q)
+
+    def surrogate_select(self, q, q0):
+        """
+        Metropolis accept/reject of q with the likelihood emulated by
+        the surrogate.
+        """
+        if self.surrogate_mode == 'replace':
+            # approx_logp0 is the logp of the current state as used for
+            # acceptance, emulated or exact
+            if self.approx_logp0 is None:
+                self.approx_logp0 = self.logp0
+            like, sd = self.surrogate.predict(q, return_sd=True)
+            if sd < self.surrogate.tol:
+                logp = None
+                approx_logp = self.check_bnd(q) + like
+            else:
+                logp = approx_logp = self.logp_forw(q)
+            q_new = metropolis.metrop_select(
+                self.beta * (approx_logp - self.approx_logp0), q, q0)
+        else:
+            # Delayed acceptance: screen on the approximation, then correct
+            # for it with the forward model
+            if self.logp0 is None:
+                self.logp0 = self.logp_forw(q0)
+            if self.approx_logp0 is None:
+                self.approx_logp0 = self.approx_logp(q0)
+            approx_logp = self.approx_logp(q)
+            delta_approx = approx_logp - self.approx_logp0
+            if not np.log(np.random.uniform()) < self.beta * delta_approx:
+                return q0
+            logp = self.logp_forw(q)
+            q_new = metropolis.metrop_select(
+                self.beta * (logp - self.logp0 - delta_approx), q, q0)
+
+        if q_new is q:
+            self.accepted += 1
+            self.logp0 = logp
+            self.approx_logp0 = approx_logp
+        return q_new
+
+    def fit_surrogate(self):
+        """
+        Add the end points of the chains of the last stage and their
+        likelihoods to the surrogate.
+        """
+        if self.surrogate is not None:
+            self.surrogate.add(self.array_population, self.likelihoods)
+
+    def population_function(self, model):
+        """
+        Compiled function of a matrix with the flat values of the variables
+        of one chain in every row, that returns the logp and the likelihood
+        of every row. With check_bound, rows outside of the support of the
+        variables get -inf for both without evaluating the likelihood.
+        """
+        if self.population_fn is None:
+            shared = {model[name]: share
+                      for name, share in self.shared.items()}
+            for name, share in self.shared.items():
+                share.container.storage[0] = model.test_point[name]
+            outs = [model.logpt, self.likelihood_var]
+            if self.check_bound:
+                varlogp = model.varlogpt
+                outs = ifelse(tt.or_(tt.isnan(varlogp), tt.isinf(varlogp)),
+                              [tt.constant(-np.inf, dtype=out.dtype)
+                               for out in outs],
+                              outs)
+            self.population_fn = logp_forw_population(outs, self.vars, shared)
+        return self.population_fn
+
     def calc_beta(self):
         """
         Calculate next tempering beta and importance weights based on
@@ -280,6 +397,27 @@ class ATMCMC(ArrayStepShared):
 
         return population, array_population, likelihoods
 
+    def collect_end_points(self, array_population, likelihoods):
+        """
+        Take the end points of the chains, as returned by the chains of a
+        stage, as start population for the next stage.
+
+        Parameters
+        -------
+
+        array_population : Ndarray of trace end-points
+        likelihoods : Ndarray of likelihoods of the trace end-points
+
+        Returns
+        -------
+        population : List of pymc3.Point - objects,
+        array_population : Ndarray of trace end-points
+        likelihoods : Ndarray of likelihoods of the trace end-points
+        """
+        bij = DictToArrayBijection(self.ordering, self.population[0])
+        population = [bij.rmap(q) for q in array_population]
+        return population, array_population, likelihoods
+
     def resample(self):
         """
         Resample pdf based on importance weights.
@@ -289,35 +427,16 @@ class ATMCMC(ArrayStepShared):
         -------
         outindex : Ndarray of resampled trace indexes
         """
-        parents = np.array(range(self.n_chains))
-        N_childs = np.zeros(self.n_chains, dtype=int)
-
         cum_dist = np.cumsum(self.weights)
-        aux = np.random.rand(1)
-        u = parents + aux
-        u /= self.n_chains
-        j = 0
-        for i in parents:
-            while u[i] > cum_dist[j]:
-                j += 1
-
-            N_childs[j] += 1
-
-        indx = 0
-        outindx = np.zeros(self.n_chains, dtype=int)
-        for i in parents:
-            if N_childs[i] > 0:
-                for j in range(indx, (indx + N_childs[i])):
-                    outindx[j] = parents[i]
-
-            indx += N_childs[i]
-
-        return outindx
+        u = (np.arange(self.n_chains) + np.random.rand(1)) / self.n_chains
+        # the parent of every child is the first with cum_dist >= u
+        outindx = np.searchsorted(cum_dist, u)
+        return np.minimum(outindx, self.n_chains - 1)
 
 
 def ATMIP_sample(n_steps, step=None, start=None, trace=None, chain=0,
                   stage=None, njobs=1, tune=None, progressbar=False,
-                  model=None, random_seed=None):
+                  model=None, random_seed=None, vectorize=False):
     """
     (C)ATMIP sampling algorithm from Minson et al. 2013:
     Bayesian inversion for finite fault earthquake source models I-
@@ -345,11 +464,11 @@ def ATMIP_sample(n_steps, step=None, start=None, trace=None, chain=0,
     start : List of dicts with length(n_chains)
         Starting points in parameter space (or partial point)
         Defaults to random draws from variables (defaults to empty dict)
-    trace : backend
-        This should be a backend instance.
-        Passing either "text" or "sqlite" is taken as a shortcut to set
-        up the corresponding backend (with "mcmc" used as the base
-        name).
+    trace : string
+        Result folder that the traces of all stages are written to as CSV
+        files, in a background thread while the next stage is sampled. Will
+        be created if not existing. If None, stages are only exchanged in
+        memory and just the final stage is kept. Defaults to None.
     chain : int
         Chain number used to store sample in backend. If `njobs` is
         greater than one, chain numbers will start here.
@@ -363,7 +482,6 @@ def ATMIP_sample(n_steps, step=None, start=None, trace=None, chain=0,
         step.n_chains / njobs has to be an integer number!
     tune : int
         Number of iterations to tune, if applicable (defaults to None)
-    trace : result_folder for storing stages, will be created if not existing
     progressbar : bool
         Flag for progress bar
     model : Model (optional if in `with` context) has to contain deterministic
@@ -371,10 +489,16 @@ def ATMIP_sample(n_steps, step=None, start=None, trace=None, chain=0,
             model likelihood
     random_seed : int or list of ints
         A list is accepted if more if `njobs` is greater than one.
+    vectorize : boolean
+        Advance the chains of a stage in lockstep, evaluating the logp of
+        the proposals of all chains in one call of a compiled function,
+        instead of sampling every chain on its own. Suited to cheap
+        likelihoods, for which the per call overhead dominates. Ignores
+        njobs and the surrogate of the step.
 
     Returns
     -------
-    MultiTrace object with access to sampling values
+    MultiTrace object with access to the samples of the final stage
     """
 
     model = modelcontext(model)
@@ -387,10 +511,6 @@ def ATMIP_sample(n_steps, step=None, start=None, trace=None, chain=0,
     if step is None:
         raise Exception('Argument `step` has to be a TMCMC step object.')
 
-    if trace is None:
-        raise Exception('Argument `trace` should be either sqlite or text '
-                        'backend object.')
-
     if start is not None:
         if len(start) != step.n_chains:
             raise Exception('Argument `start` should have dicts equal the '
@@ -402,7 +522,7 @@ def ATMIP_sample(n_steps, step=None, start=None, trace=None, chain=0,
         step.stage = stage
 
     if not any(
-            step.likelihood_name in var.name for var in model.deterministics):
+            step.likelihood_name == var.name for var in model.deterministics):
             raise Exception('Model (deterministic) variables need to contain '
                             'a variable `' + step.likelihood_name + '` as '
                             'defined in `step`.')
@@ -413,10 +533,14 @@ def ATMIP_sample(n_steps, step=None, start=None, trace=None, chain=0,
         verbosity = 0
 
     homepath = trace
+    keep_traces = homepath is not None
 
-    if not os.path.exists(homepath):
+    if keep_traces and not os.path.exists(homepath):
         os.mkdir(homepath)
 
+    # stage traces are written to disk while the next stage is sampled
+    writers = []
+
     with model:
         with Parallel(n_jobs=njobs, verbose=verbosity) as parallel:
             while step.beta < 1.:
@@ -424,41 +548,56 @@ def ATMIP_sample(n_steps, step=None, start=None, trace=None, chain=0,
                 if step.stage == 0:
                     # Initial stage
                     print('Sample initial stage: ...')
-                    stage_path = homepath + '/stage_' + str(step.stage)
-                    trace = Text(stage_path, model=model)
-                    initial = _iter_initial(step, chain=chain, trace=trace)
-                    progress = progress_bar(step.n_chains)
-                    try:
-                        for i, strace in enumerate(initial):
-                            if progressbar:
-                                progress.update(i)
-                    except KeyboardInterrupt:
-                        strace.close()
-                    mtrace = MultiTrace([strace])
+                    stage_path = _stage_path(homepath, step.stage)
+                    if keep_traces and os.path.exists(
+                            os.path.join(stage_path, 'chain-0.csv')):
+                        print('Using results of previous run!')
+                        mtrace = text.load(stage_path, model=model)
+                    else:
+                        initial = _iter_initial(step, chain=chain,
+                                                model=model)
+                        progress = progress_bar(step.n_chains)
+                        try:
+                            for i, strace in enumerate(initial):
+                                if progressbar:
+                                    progress.update(i)
+                        except KeyboardInterrupt:
+                            strace.close()
+                        mtrace = MultiTrace([strace])
+                        if keep_traces:
+                            writers.append(_dump_stage(stage_path, mtrace))
                     step.population, step.array_population, step.likelihoods = \
                                             step.select_end_points(mtrace)
+                    step.fit_surrogate()
                     step.beta, step.old_beta, step.weights = step.calc_beta()
                     step.covariance = step.calc_covariance()
                     step.res_indx = step.resample()
                     step.stage += 1
-                    del(strace, mtrace, trace)
+                    del(mtrace)
                 else:
                     if progressbar and njobs > 1:
                         progressbar = False
                     # Metropolis sampling intermediate stages
-                    stage_path = homepath + '/stage_' + str(step.stage)
+                    stage_path = _stage_path(homepath, step.stage)
                     step.proposal_dist = MvNPd(step.covariance)
 
                     sample_args = {
                             'draws': n_steps,
                             'step': step,
-                            'stage_path': stage_path,
-                            'progressbar': progressbar,
+                            'keep_traces': keep_traces,
                             'model': model}
-                    mtrace = _iter_parallel_chains(parallel, **sample_args)
+                    if vectorize:
+                        array_population, likelihoods, mtrace = \
+                                _sample_population(**sample_args)
+                    else:
+                        array_population, likelihoods, mtrace = \
+                                _iter_parallel_chains(parallel, **sample_args)
+                    if keep_traces:
+                        writers.append(_dump_stage(stage_path, mtrace))
 
                     step.population, step.array_population, step.likelihoods = \
-                                            step.select_end_points(mtrace)
+                        step.collect_end_points(array_population, likelihoods)
+                    step.fit_surrogate()
                     step.beta, step.old_beta, step.weights = step.calc_beta()
                     step.stage += 1
 
@@ -472,7 +611,7 @@ def ATMIP_sample(n_steps, step=None, start=None, trace=None, chain=0,
 
             # Metropolis sampling final stage
             print('Sample final stage')
-            stage_path = homepath + '/stage_final'
+            stage_path = _stage_path(homepath, 'final')
             temp = np.exp((1 - step.old_beta) * \
                                (step.likelihoods - step.likelihoods.max()))
             step.weights = temp / np.sum(temp)
@@ -480,12 +619,39 @@ def ATMIP_sample(n_steps, step=None, start=None, trace=None, chain=0,
             step.proposal_dist = MvNPd(step.covariance)
             step.res_indx = step.resample()
 
-            sample_args['step'] = step
-            sample_args['stage_path'] = stage_path
-            mtrace = _iter_parallel_chains(parallel, **sample_args)
-            return mtrace
-       
-            
+            sample_args = {
+                    'draws': n_steps,
+                    'step': step,
+                    'keep_traces': True,
+                    'model': model}
+            if vectorize:
+                _, _, mtrace = _sample_population(**sample_args)
+            else:
+                _, _, mtrace = _iter_parallel_chains(parallel, **sample_args)
+            if keep_traces:
+                writers.append(_dump_stage(stage_path, mtrace))
+
+    for writer in writers:
+        writer.join()
+    return mtrace
+
+
+def _stage_path(homepath, stage):
+    if homepath is None:
+        return None
+    return os.path.join(homepath, 'stage_' + str(stage))
+
+
+def _dump_stage(stage_path, mtrace):
+    """
+    Write the traces of a stage to CSV files in a background thread and
+    return the thread.
+    """
+    writer = threading.Thread(target=text.dump, args=(stage_path, mtrace))
+    writer.start()
+    return writer
+
+
 def _choose_backend(trace, chain, shortcuts=None, **kwds):
     if isinstance(trace, BaseTrace):
         return trace
@@ -513,76 +679,134 @@ def _iter_initial(step, chain=0, trace=None, model=None):
     _iter_sample, just different input to loop over.
     """
 
-    strace = sampling._choose_backend(trace, chain, model=model)
-    # check if trace file already exists before setup
-    filename = os.path.join(strace.name, 'chain-{}.csv'.format(chain))
-    if os.path.exists(filename):
-        strace.setup(step.n_chains, chain=0)
-        l_tr = len(strace)
-    else:
-        strace.setup(step.n_chains, chain=0)
-        l_tr = 0
-
-    if l_tr == step.n_chains:
-        # only return strace
-        for i in range(1):
-            print('Using results of previous run!')
-            yield strace
+    strace = _choose_backend(trace, chain, model=model)
+    strace.setup(step.n_chains, chain=0)
+
+    for i in range(step.n_chains):
+        point = step.step(step.population[i])
+        strace.record(point)
+        yield strace
     else:
-        for i in range(l_tr, step.n_chains):
-            point = step.step(step.population[i])
-            strace.record(point)
-            yield strace
-        else:
-            strace.close()
+        strace.close()
 
 
-def _iter_serial_chains(draws, step=None, stage_path=None,
-                        progressbar=True, model=None):
+def _sample_chain(draws, step, start, chain, keep_traces, model,
+                  random_seed=None):
     """
-    Do Metropolis sampling over all the chains with each chain being
-    sampled 'draws' times. Serial execution one after another.
+    Do Metropolis sampling of one chain of a stage.
+
+    Returns
+    -------
+    end point : Ndarray of the values of step.vars at the end of the chain
+    likelihood : scalar float, likelihood of the end point
+    mtrace : MultiTrace of the chain if keep_traces, otherwise None
     """
-    mtraces = []
-    progress = progress_bar(step.n_chains)
-    for chain in range(step.n_chains):
-        if progressbar:
-            progress.update(chain)
-        trace = Text(stage_path, model=model)
-        mtraces.append(sampling._sample(
-                draws=draws,
-                step=step,
-                chain=chain,
-                trace=trace,
-                model=model,
-                progressbar=False,
-                start=step.population[step.res_indx[chain]]))
-
-    return sampling.merge_traces(mtraces)
-
-
-def _iter_parallel_chains(parallel, **kwargs):
+    from ..sampling import _sample
+
+    if keep_traces:
+        mtrace = _sample(draws=draws, step=step, start=start, chain=chain,
+                         progressbar=False, model=model,
+                         random_seed=random_seed)
+        point = mtrace.point(-1, chain=chain)
+        likelihood = point[step.likelihood_name]
+    else:
+        mtrace = None
+        point = model.test_point
+        point.update(start)
+        point = ArrayPoint(model.vars, point)
+        for i in range(draws):
+            point = step.step(point)
+        likelihood = step.likelihood(point)
+
+    end_point = DictToArrayBijection(step.ordering, point).map(point)
+    return end_point, likelihood, mtrace
+
+
+def _iter_parallel_chains(parallel, draws, step, keep_traces, model):
     """
     Do Metropolis sampling over all the chains with each chain being
     sampled 'draws' times. Parallel execution according to njobs.
+
+    Returns
+    -------
+    array_population : Ndarray of the end points of the chains
+    likelihoods : Ndarray of the likelihoods of the end points
+    mtrace : MultiTrace of all chains if keep_traces, otherwise None
     """
-    stage_path = kwargs.pop('stage_path')
-    step = kwargs['step']
-    chains = list(range(step.n_chains))
-    trace_list = []
+    print('Sampling ...')
+    # `_sample` seeds the random generator of every chain
+    rseeds = np.random.randint(2 ** 30, size=step.n_chains)
+    results = parallel(delayed(_sample_chain)(
+                            draws=draws,
+                            step=step,
+                            start=step.population[step.res_indx[chain]],
+                            chain=chain,
+                            keep_traces=keep_traces,
+                            model=model,
+                            random_seed=rseeds[chain])
+                       for chain in range(step.n_chains))
+
+    end_points, likelihoods, mtraces = zip(*results)
+    if keep_traces:
+        mtrace = merge_traces(list(mtraces))
+    else:
+        mtrace = None
+    return np.array(end_points), np.array(likelihoods), mtrace
 
-    print('Initialising chain traces ...')
-    for chain in chains:
-        trace_list.append(Text(stage_path))
 
-    print('Sampling ...')
-    traces = parallel(delayed(
-                    sampling._sample)(
-                        chain=chain,
-                        trace=trace_list[chain],
-                        start=step.population[step.res_indx[chain]],
-                        **kwargs) for chain in chains)
-    return sampling.merge_traces(traces)
+def _sample_population(draws, step, keep_traces, model):
+    """
+    Do Metropolis sampling over all the chains in lockstep, with the logp
+    of the proposals of all chains evaluated in one call.
+
+    Returns
+    -------
+    array_population : Ndarray of the end points of the chains
+    likelihoods : Ndarray of the likelihoods of the end points
+    mtrace : MultiTrace of all chains if keep_traces, otherwise None
+    """
+    if keep_traces:
+        straces = [NDArray(model=model) for chain in range(step.n_chains)]
+        for chain, strace in enumerate(straces):
+            strace.setup(draws, chain)
+        bij = DictToArrayBijection(step.ordering, step.population[0])
+
+    f = step.population_function(model)
+    q0 = step.array_population[step.res_indx]
+    # logp and likelihood of the current states
+    outs0 = f(q0)
+
+    accepted = 0
+    for i in range(draws):
+        if step.tune and i and not i % step.tune_interval:
+            step.scaling = tune(
+                accepted / float(step.tune_interval * step.n_chains))
+            accepted = 0
+
+        delta = step.proposal_dist(step.n_chains) * step.scaling
+        if step.any_discrete:
+            delta[:, step.discrete] = np.round(delta[:, step.discrete], 0)
+        q = q0 + delta
+
+        outs = f(q)
+        accept = (np.log(np.random.uniform(size=step.n_chains)) <
+                  step.beta * (outs[0] - outs0[0]))
+        q0[accept] = q[accept]
+        for out0, out in zip(outs0, outs):
+            out0[accept] = out[accept]
+        accepted += accept.sum()
+
+        if keep_traces:
+            for strace, q_chain in zip(straces, q0):
+                strace.record(bij.rmap(q_chain))
+
+    if keep_traces:
+        for strace in straces:
+            strace.close()
+        mtrace = MultiTrace(straces)
+    else:
+        mtrace = None
+    return q0, outs0[1], mtrace
 
 
 def tune(acc_rate):
@@ -609,3 +833,19 @@ def logp_forw(logp, vars, shared):
     f = theano.function([inarray0], logp0)
     f.trust_input = True
     return f
+
+
+def logp_forw_population(outs, vars, shared):
+    """
+    Compile a function of a matrix with the flat values of vars in every
+    row, that returns outs for every row.
+    """
+    outs, inarray0 = join_nonshared_inputs(outs, vars, shared)
+    population = tt.matrix('population', dtype=inarray0.dtype)
+    population.tag.test_value = inarray0.tag.test_value[None, :]
+    rows, _ = theano.map(
+        lambda q: theano.clone(outs, replace={inarray0: q}),
+        sequences=[population])
+    f = theano.function([population], rows)
+    f.trust_input = True
+    return f
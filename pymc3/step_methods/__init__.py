@@ -3,6 +3,8 @@ from .compound import CompoundStep
 from .hmc import HamiltonianMC
 
 from .metropolis import Metropolis
+from .metropolis import DelayedAcceptanceMetropolis
+from .metropolis import AdaptiveMetropolis
 from .metropolis import BinaryMetropolis
 from .metropolis import BinaryGibbsMetropolis
 from .metropolis import NormalProposal
@@ -13,11 +15,19 @@ from .metropolis import MultivariateNormalProposal
 
 from .gibbs import ElemwiseCategorical
 
+from .conjugate import ConjugateGibbs
+
 from .slicer import Slice
 
 from .nuts import NUTS
 
 from .ATMCMC import ATMCMC
 from .ATMCMC import ATMIP_sample
+from .surrogate import GPSurrogate
+
+from .ensemble import Ensemble
+from .ensemble import sample_ensemble
+
+from .tempering import sample_tempered
 
 from .arraystep import Constant
\ No newline at end of file
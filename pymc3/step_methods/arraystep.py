@@ -1,7 +1,7 @@
 from .compound import CompoundStep
 from ..model import modelcontext
 from ..theanof import inputvars
-from ..blocking import ArrayOrdering, DictToArrayBijection
+from ..blocking import ArrayOrdering, DictToArrayBijection, ArrayPoint
 import numpy as np
 from numpy.random import uniform
 from numpy import log, isfinite
@@ -57,14 +57,14 @@ class BlockedStep(object):
                 # call __init__
                 step.__init__([var], *args, **kwargs)
                 # Hack for creating the class correctly when unpickling.
-                step.__newargs = ([var], ) + args, kwargs
+                step.__newargs = ([var], ) + args, dict(kwargs, model=model)
                 steps.append(step)
 
             return CompoundStep(steps)
         else:
             step = super(BlockedStep, cls).__new__(cls)
             # Hack for creating the class correctly when unpickling.
-            step.__newargs = (vars, ) + args, kwargs
+            step.__newargs = (vars, ) + args, dict(kwargs, model=model)
             return step
 
     # Hack for creating the class correctly when unpickling.
@@ -95,6 +95,11 @@ class ArrayStep(BlockedStep):
         if self.allvars:
             inputs += [point]
 
+        if isinstance(point, ArrayPoint):
+            apoint = self.astep(point.get_array(self.ordering), *inputs)
+            point.set_array(self.ordering, apoint)
+            return point
+
         apoint = self.astep(bij.map(point), *inputs)
         return bij.rmap(apoint)
 
@@ -118,14 +123,31 @@ class ArrayStepShared(BlockedStep):
         self.shared = { str(var) : shared for var, shared in shared.items() }
         self.blocked = blocked
 
+        # the point returned by the last step
+        self.point = None
+        self.point_version = None
+        self.point_changed = True
+
     def step(self, point):
+        # Whether the point has changed since this step method returned it,
+        # for step methods that keep values computed at their last sample.
+        self.point_changed = (point is not self.point or
+                              getattr(point, 'version', None) != self.point_version)
+
         for var, share in self.shared.items():
             share.container.storage[0] = point[var]
 
-        bij = DictToArrayBijection(self.ordering, point)
+        if isinstance(point, ArrayPoint):
+            apoint = self.astep(point.get_array(self.ordering))
+            point.set_array(self.ordering, apoint)
+        else:
+            bij = DictToArrayBijection(self.ordering, point)
+            apoint = self.astep(bij.map(point))
+            point = bij.rmap(apoint)
 
-        apoint = self.astep(bij.map(point))
-        return bij.rmap(apoint)
+        self.point = point
+        self.point_version = getattr(point, 'version', None)
+        return point
 
 def metrop_select(mr, q, q0):
     # Perform rejection/acceptance step for Metropolis class samplers
@@ -0,0 +1,189 @@
+'''
+Gibbs sampling from the closed-form conditionals of conjugate models.
+'''
+import numpy as np
+import theano
+import theano.tensor as tt
+from theano.gof.graph import inputs
+
+from .arraystep import ArrayStepShared, Competence
+from ..distributions import Normal, Gamma, Beta, Poisson, Binomial, Bernoulli
+from ..distributions.transforms import TransformedDistribution
+from ..model import modelcontext
+from ..theanof import inputvars, make_shared_replacements
+
+__all__ = ['ConjugateGibbs']
+
+
+class ConjugateGibbs(ArrayStepShared):
+    """
+    Gibbs sampling step that draws a variable from its exact conditional
+    distribution given the rest of the model.
+
+    Applies when every factor that depends on the variable is one of its
+    children, and prior and children form one of these conjugate pairs:
+
+    - Normal prior on the mean `mu` of Normal children
+    - Gamma prior on the precision `tau` of Normal children
+    - Gamma prior on the mean `mu` of Poisson children
+    - Beta prior on the probability `p` of Binomial or Bernoulli children
+
+    Parameters
+    ----------
+    vars : list
+        List of variables for sampler
+    model : PyMC Model
+        Optional model for sampling step. Defaults to None (taken from context).
+    """
+    default_blocked = False
+
+    def __init__(self, vars, model=None, **kwargs):
+        model = modelcontext(model)
+        vars = inputvars(vars)
+
+        if len(vars) != 1:
+            raise ValueError('ConjugateGibbs samples a single variable')
+        var, = vars
+
+        conjugate = conjugate_stats(var, model)
+        if conjugate is None:
+            raise ValueError(
+                'The prior of {} is not conjugate to its children'.format(var))
+        prior, stats = conjugate
+
+        self.shape = var.dshape
+        self.draw = draws[type(prior)]
+
+        shared = make_shared_replacements(vars, model)
+        stats = theano.clone([tt.as_tensor_variable(s) for s in stats],
+                             replace=shared)
+        self.stats = theano.function([], stats, on_unused_input='ignore')
+
+        transform = getattr(var.distribution, 'transform_used', None)
+        if transform is None:
+            self.forward = None
+        else:
+            x = tt.dvector('x')
+            x.tag.test_value = (np.ones(var.dsize) *
+                                var.distribution.dist.default())
+            self.forward = theano.function([x], transform.forward(x))
+
+        super(ConjugateGibbs, self).__init__(vars, shared, **kwargs)
+
+    def astep(self, q0):
+        stats = [sum_to_shape(s, self.shape) for s in self.stats()]
+        # Natural parameters of the conditional, prior plus children
+        a = stats[0] + sum(stats[2::2])
+        b = stats[1] + sum(stats[3::2])
+
+        q = np.atleast_1d(self.draw(a, b)).astype('float64').ravel()
+        if self.forward is not None:
+            q = self.forward(q)
+        return q
+
+    @staticmethod
+    def competence(var):
+        model = modelcontext(getattr(var, 'model', None))
+        if conjugate_stats(var, model) is not None:
+            return Competence.IDEAL
+        return Competence.INCOMPATIBLE
+
+
+def conjugate_stats(var, model):
+    """
+    Find the prior of var and the statistics of its conditional distribution.
+
+    Returns
+    -------
+    None if var is not conjugate to its children, otherwise the prior and a
+    list of tensors: the two parameters of the prior, followed by two
+    sufficient statistics of each child. The parameters of the conditional
+    are the sums of the first and of the second of each pair.
+    """
+    prior = var.distribution
+    rv = var
+    if isinstance(prior, TransformedDistribution):
+        prior = prior.dist
+        rv = [v for v in model.deterministics
+              if getattr(v, 'transformed', None) is var][0]
+
+    if type(prior) not in draws:
+        return None
+
+    if any(depends_on(var, potential) for potential in model.potentials):
+        return None
+
+    children = [v for v in model.basic_RVs
+                if v is not var and depends_on(var, v.logpt)]
+    if not children:
+        return None
+
+    if isinstance(prior, Normal):
+        stats = [prior.tau, prior.tau * prior.mu]
+    else:
+        stats = [prior.alpha, prior.beta]
+
+    for child in children:
+        child_stats = conjugate_child_stats(prior, var, rv, child)
+        if child_stats is None:
+            return None
+        stats.extend(child_stats)
+
+    return prior, stats
+
+
+def conjugate_child_stats(prior, var, rv, child):
+    dist = child.distribution
+    ones = tt.ones_like(child, dtype='float64')
+
+    if isinstance(prior, Normal) and isinstance(dist, Normal):
+        if unwrap(dist.mu) is rv and not depends_on(var, dist.tau):
+            return [dist.tau * ones, dist.tau * child]
+    elif isinstance(prior, Gamma) and isinstance(dist, Normal):
+        if unwrap(dist.tau) is rv and not depends_on(var, dist.mu):
+            return [.5 * ones, .5 * (child - dist.mu) ** 2]
+    elif isinstance(prior, Gamma) and isinstance(dist, Poisson):
+        if unwrap(dist.mu) is rv:
+            return [child * ones, ones]
+    elif isinstance(prior, Beta) and isinstance(dist, Binomial):
+        if unwrap(dist.p) is rv and not depends_on(var, dist.n):
+            return [child * ones, (dist.n - child) * ones]
+    elif isinstance(prior, Beta) and isinstance(dist, Bernoulli):
+        if unwrap(dist.p) is rv:
+            return [child * ones, (1 - child) * ones]
+    return None
+
+
+def depends_on(var, x):
+    return isinstance(x, theano.Variable) and var in inputs([x])
+
+
+def unwrap(x):
+    """Strip multiplications by one, such as the `1. * tau` of get_tau_sd."""
+    owner = getattr(x, 'owner', None)
+    if (owner is not None and isinstance(owner.op, tt.Elemwise) and
+            isinstance(owner.op.scalar_op, theano.scalar.Mul) and
+            len(owner.inputs) == 2):
+        for one, y in [owner.inputs, owner.inputs[::-1]]:
+            try:
+                if tt.get_scalar_constant_value(one) == 1:
+                    return unwrap(y)
+            except tt.NotScalarConstantError:
+                pass
+    return x
+
+
+def sum_to_shape(x, shape):
+    """Sum x over the dimensions along which a value of shape was broadcast."""
+    x = np.asarray(x, dtype='float64')
+    x = np.broadcast_to(x, np.broadcast(x, np.empty(shape)).shape)
+    x = x.sum(axis=tuple(range(x.ndim - len(shape))))
+    axes = tuple(i for i, n in enumerate(shape) if n == 1 and x.shape[i] != 1)
+    return x.sum(axis=axes, keepdims=True).reshape(shape)
+
+
+draws = {
+    Normal: lambda a, b: np.random.normal(b / a, a ** -.5),
+    Gamma: lambda a, b: np.random.gamma(a, 1. / b),
+    Beta: lambda a, b: np.random.beta(a, b),
+}
@@ -0,0 +1,240 @@
+'''
+Ensemble samplers that move a population of walkers at every iteration.
+'''
+import multiprocessing
+
+import numpy as np
+from numpy.random import normal, randint, seed, uniform
+
+from ..backends.base import MultiTrace
+from ..blocking import ArrayOrdering, DictToArrayBijection
+from ..model import modelcontext, Point
+from ..progressbar import progress_bar
+from ..theanof import inputvars
+
+__all__ = ['Ensemble', 'sample_ensemble']
+
+
+class Ensemble(object):
+    """
+    Gradient free ensemble sampler.
+
+    The walkers are split in two halves and each half is moved at once with
+    proposals built from the walkers of the other half, using either the
+    affine invariant stretch move of Goodman & Weare (2010) or the
+    differential evolution move of ter Braak (2006). The log-probability of
+    all proposals of a half is evaluated in one batch, optionally spread over
+    a pool of worker processes.
+
+    Parameters
+    ----------
+    vars : list
+        List of variables for sampler. Defaults to the continuous variables.
+    n_walkers : int
+        Even number of walkers. Defaults to twice the number of dimensions
+        plus two.
+    move : 'stretch' or 'de'
+        Proposal used to move the walkers.
+    scale : float
+        Scale parameter of the stretch move (defaults to 2) or factor of the
+        differential evolution move (defaults to 2.38 / sqrt(2 * ndim)).
+    epsilon : float
+        Standard deviation of the jitter added to differential evolution
+        proposals.
+    njobs : int
+        Number of processes used to evaluate the log-probability of the
+        walkers.
+    model : PyMC Model
+        Optional model for sampling step. Defaults to None (taken from context).
+    """
+
+    def __init__(self, vars=None, n_walkers=None, move='stretch', scale=None,
+                 epsilon=1e-4, njobs=1, model=None):
+        model = modelcontext(model)
+        if vars is None:
+            vars = model.cont_vars
+        vars = inputvars(vars)
+
+        self.vars = vars
+        self.ordering = ArrayOrdering(vars)
+        self.ndim = self.ordering.dimensions
+
+        if n_walkers is None:
+            n_walkers = 2 * self.ndim + 2
+        if n_walkers % 2 or n_walkers < 4:
+            raise ValueError('n_walkers has to be an even number of at least 4')
+        if move not in ('stretch', 'de'):
+            raise ValueError("move has to be 'stretch' or 'de'")
+        if scale is None:
+            scale = 2. if move == 'stretch' else 2.38 / np.sqrt(2 * self.ndim)
+
+        self.n_walkers = n_walkers
+        self.move = move
+        self.scale = scale
+        self.epsilon = epsilon
+        self.njobs = njobs
+        self.pool = None
+
+        self.logp = model.logp_dlogp_function(vars, grad=False)
+        self.accepted = np.zeros(n_walkers)
+
+    def set_point(self, point):
+        """
+        Set the values of the variables the ensemble does not sample and
+        start the worker pool if `njobs` is greater than one.
+        """
+        self.logp.set_point(point)
+        self.close()
+        if self.njobs > 1:
+            self.pool = multiprocessing.Pool(
+                self.njobs, initializer=_init_worker,
+                initargs=(self.logp, point))
+
+    def close(self):
+        """Shut down the worker pool."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def logp_population(self, population):
+        """Log-probability of every row of `population`."""
+        if self.pool is None:
+            return _logp_population(self.logp, population)
+        chunks = np.array_split(population, self.njobs)
+        return np.concatenate(self.pool.map(_worker_logp, chunks))
+
+    def step(self, population, logps):
+        """
+        Move all walkers once, updating `population` (walkers x dimensions)
+        and their log-probabilities `logps` in place.
+        """
+        half = self.n_walkers // 2
+        walkers = np.arange(self.n_walkers)
+        for active, others in [(walkers[:half], walkers[half:]),
+                               (walkers[half:], walkers[:half])]:
+            self.move_half(population, logps, active, others)
+        return population, logps
+
+    def move_half(self, population, logps, active, others):
+        q0 = population[active]
+        partners = population[others]
+        n = len(active)
+        j = randint(len(others), size=n)
+
+        if self.move == 'stretch':
+            z = ((self.scale - 1.) * uniform(size=n) + 1.) ** 2 / self.scale
+            q = partners[j] + z[:, None] * (q0 - partners[j])
+            log_ratio = (self.ndim - 1.) * np.log(z)
+        else:
+            k = (j + randint(1, len(others), size=n)) % len(others)
+            q = (q0 + self.scale * (partners[j] - partners[k]) +
+                 self.epsilon * normal(size=q0.shape))
+            log_ratio = 0.
+
+        logp = self.logp_population(q)
+        accept = np.log(uniform(size=n)) < log_ratio + logp - logps[active]
+
+        population[active[accept]] = q[accept]
+        logps[active[accept]] = logp[accept]
+        self.accepted[active] += accept
+
+
+def _logp_population(logp, population):
+    return np.array([logp(np.ascontiguousarray(q)) for q in population])
+
+
+_worker_logp_function = None
+
+
+def _init_worker(logp, point):
+    global _worker_logp_function
+    logp.set_point(point)
+    _worker_logp_function = logp
+
+
+def _worker_logp(population):
+    return _logp_population(_worker_logp_function, population)
+
+
+def sample_ensemble(draws, step=None, start=None, trace=None, progressbar=True,
+                    model=None, random_seed=None):
+    """
+    Draw samples with an ensemble step method, recording every walker as
+    a separate chain.
+
+    Parameters
+    ----------
+    draws : int
+        The number of samples to draw for every walker
+    step : Ensemble
+        Ensemble step method. Defaults to an Ensemble over the continuous
+        variables of the model.
+    start : dict or list of dicts
+        Starting point in parameter space (or partial point), from which
+        the walkers are started in a small ball, or a list with one point per
+        walker. Defaults to model.test_point.
+    trace : str or list
+        The name of a backend ('text' or 'sqlite'), a list of variables to
+        track or None. If None or a list of variables, the NDArray backend is
+        used.
+    progressbar : bool
+        Flag for progressbar
+    model : Model (optional if in `with` context)
+    random_seed : int
+        Random seed
+
+    Returns
+    -------
+    MultiTrace object with one chain per walker
+    """
+    from ..sampling import _choose_backend
+
+    model = modelcontext(model)
+    if step is None:
+        step = Ensemble(model=model)
+    seed(random_seed)
+
+    if isinstance(start, (list, tuple)):
+        if len(start) != step.n_walkers:
+            raise ValueError('start needs one point per walker')
+        points = [Point(model.test_point, model=model, **p) for p in start]
+    else:
+        point = model.test_point
+        point.update(start or {})
+        points = [Point(point, model=model)]
+
+    bij = DictToArrayBijection(step.ordering, points[0])
+    population = np.array([bij.map(p) for p in points], dtype='float64')
+    if len(points) == 1:
+        q = population[0]
+        population = q + 1e-2 * (1. + np.abs(q)) * normal(
+            size=(step.n_walkers, step.ndim))
+
+    straces = []
+    for chain in range(step.n_walkers):
+        strace = _choose_backend(trace, chain, model=model)
+        if chain and strace is straces[0]:
+            raise ValueError('Pass a backend class or a list of '
+                             'variables to record every walker')
+        strace.setup(draws, chain)
+        straces.append(strace)
+
+    step.set_point(points[0])
+    try:
+        logps = step.logp_population(population)
+        progress = progress_bar(draws)
+        for i in range(draws):
+            step.step(population, logps)
+            for strace, q in zip(straces, population):
+                strace.record(bij.rmap(q))
+            if progressbar:
+                progress.update(i)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        step.close()
+
+    for strace in straces:
+        strace.close()
+    return MultiTrace(straces)
@@ -3,22 +3,27 @@ Created on May 12, 2012
 
 @author: john
 '''
-from .arraystep import ArrayStep, Competence
+from .arraystep import ArrayStepShared, Competence
 from ..distributions.discrete import Categorical
-from numpy import array, max, exp, cumsum, nested_iters, empty, searchsorted, ones, arange
-from numpy.random import uniform
+from numpy import arange, argmax, array, log, shape
+from numpy.random import standard_exponential
 
+import theano
 from theano.gof.graph import inputs
-from theano.tensor import add 
-from ..model import modelcontext
+from theano.tensor import add, stack, zeros_like
+from ..model import modelcontext, ValueGradFunction
+from ..theanof import make_shared_replacements
 __all__ = ['ElemwiseCategorical']
 
 
-class ElemwiseCategorical(ArrayStep):
+class ElemwiseCategorical(ArrayStepShared):
     """
     Gibbs sampling for categorical variables that only have ElemwiseCategoricalise effects
     the variable can't be indexed into or transposed or anything otherwise that will mess things up
 
+    The elementwise log-density of every category is computed in one
+    compiled call, and all elements are drawn at once with the Gumbel-max
+    trick.
     """
     # TODO: It would be great to come up with a way to make
     # ElemwiseCategorical  more general (handling more complex elementwise
@@ -26,18 +31,24 @@ class ElemwiseCategorical(ArrayStep):
     def __init__(self, vars, values=None, model=None):
         model = modelcontext(model)
         self.var = vars[0]
-        self.sh = ones(self.var.dshape, self.var.dtype)
         if values is None:
             self.values = arange(self.var.distribution.k)
         else:
-            self.values = values
-        
+            self.values = array(values)
 
-        super(ElemwiseCategorical, self).__init__(vars, [elemwise_logp(model, self.var)])
+        shared = make_shared_replacements([self.var], model)
+        logpt = elemwise_logpt(model, self.var)
+        # Log-density of each element at each category, shape (k, size)
+        logpts = [theano.clone(logpt, {self.var: zeros_like(self.var) + v})
+                  for v in self.values]
+        self.logp = ValueGradFunction(
+            stack(logpts).reshape((len(self.values), -1)), [self.var], shared,
+            grad=False, on_unused_input='ignore')
 
-    def astep(self, q, logp):
-        p = array([logp(v * self.sh) for v in self.values])
-        return categorical(p, self.var.dshape)
+        super(ElemwiseCategorical, self).__init__([self.var], shared)
+
+    def astep(self, q0):
+        return self.values[categorical(self.logp(q0), q0.shape)]
 
     @staticmethod
     def competence(var):
@@ -50,23 +61,43 @@ class ElemwiseCategorical(ArrayStep):
         return Competence.INCOMPATIBLE
 
 def elemwise_logp(model, var):
-    terms = [v.logp_elemwiset for v in model.basic_RVs if var in inputs([v.logpt])]
-    return model.fn(add(*terms))
-
+    return model.fn(elemwise_logpt(model, var))
 
-def categorical(prob, shape):
-    out = empty([1] + list(shape))
 
-    n = len(shape)
-    it0, it1 = nested_iters([prob, out], [list(range(1, n + 1)), [0]],
-                            op_flags=[['readonly'], ['readwrite']],
-                            flags=['reduce_ok'])
-
-    for i in it0:
-        p, o = it1.itviews
-        p = cumsum(exp(p - max(p, axis=0)))
-        r = uniform() * p[-1]
+def elemwise_logpt(model, var):
+    """
+    Elementwise log-density of the factors of model that depend on var,
+    with any leading dimensions beyond the shape of var summed out.
+    Potentials have no elementwise log-density, so none may depend on var,
+    and the log-density of every factor needs the shape of var.
+    """
+    if any(var in inputs([pot]) for pot in model.potentials):
+        raise ValueError('Elementwise log-density of {} is not available, '
+                         'a Potential depends on it'.format(var.name))
+    # Shapes are only checked if test values have been computed
+    var_value = getattr(var.tag, 'test_value', None)
+    terms = []
+    for v in model.basic_RVs:
+        if var in inputs([v.logpt]):
+            term = v.logp_elemwiset
+            if term.ndim > var.ndim:
+                term = term.sum(axis=tuple(range(term.ndim - var.ndim)))
+            value = getattr(term.tag, 'test_value', None)
+            if (value is not None and var_value is not None and
+                    shape(value) != shape(var_value)):
+                raise ValueError(
+                    'Elementwise log-density of {} is not available, the '
+                    'log-density of {} has shape {} instead of {}'.format(
+                        var.name, v.name, shape(value), shape(var_value)))
+            terms.append(term)
+    return add(*terms)
 
-        o[0] = searchsorted(p, r)
 
-    return out[0, ...]
+def categorical(prob, shape):
+    """
+    Draw categories of the given shape from unnormalized log-probabilities
+    prob, with the categories along the first axis, using the Gumbel-max
+    trick.
+    """
+    prob = prob.reshape((len(prob),) + tuple(shape))
+    return argmax(prob - log(standard_exponential(prob.shape)), axis=0)
@@ -4,11 +4,11 @@ Created on Mar 7, 2011
 @author: johnsalvatier
 '''
 from numpy import floor
-from .quadpotential import quad_potential
-from .arraystep import ArrayStep, SamplerHist, metrop_select, Competence
+from .quadpotential import quad_potential, quad_potential_adapt, WindowedAdaptation
+from .arraystep import ArrayStepShared, SamplerHist, metrop_select, Competence
 from ..tuning import guess_scaling
 from ..model import modelcontext, Point
-from ..theanof import inputvars
+from ..theanof import inputvars, make_shared_replacements
 from ..vartypes import discrete_types
 
 import numpy as np
@@ -27,9 +27,11 @@ def unif(step_size, elow=.85, ehigh=1.15):
     return np.random.uniform(elow, ehigh) * step_size
 
 
-class HamiltonianMC(ArrayStep):
+class HamiltonianMC(ArrayStepShared):
     default_blocked = True
-    def __init__(self, vars=None, scaling=None, step_scale=.25, path_length=2., is_cov=False, step_rand=unif, state=None, model=None, **kwargs):
+    def __init__(self, vars=None, scaling=None, step_scale=.25, path_length=2., is_cov=False, step_rand=unif, state=None,
+                 adapt_scaling=None, adapt_window=25, adapt_buffer=75, adapt_term_buffer=50,
+                 model=None, **kwargs):
         """
         Parameters
         ----------
@@ -46,6 +48,19 @@ class HamiltonianMC(ArrayStep):
                 A function which takes the step size and returns an new one used to randomize the step size at each iteration.
             state
                 State object
+            adapt_scaling : {None, 'diag', 'dense'}
+                If set, the scaling is adapted to the sample covariance of the
+                tuning draws, estimating either its diagonal or the full matrix
+            adapt_window : int, default 25
+                Number of draws in the first adaptation window, later windows
+                double in size
+            adapt_buffer : int, default 75
+                Number of initial tuning draws not used for adaptation
+            adapt_term_buffer : int, default 50
+                Number of final tuning draws not used for adaptation, which
+                adapt the step size to the last estimate of the scaling. The
+                scaling is only adapted when the number of tuning draws is
+                given to `sample`.
             model : Model
         """
         model = modelcontext(model)
@@ -64,7 +79,15 @@ class HamiltonianMC(ArrayStep):
 
         self.step_size = step_scale / n ** (1 / 4.)
 
-        self.potential = quad_potential(scaling, is_cov, as_cov=False)
+        if adapt_scaling is None:
+            self.potential = quad_potential(scaling, is_cov, as_cov=False)
+            self.adaptation = None
+        else:
+            dense = adapt_scaling == 'dense'
+            self.potential = quad_potential_adapt(scaling, is_cov, dense)
+            self.adaptation = WindowedAdaptation(n, dense, adapt_window, adapt_buffer,
+                                                 adapt_term_buffer)
+        self.tune = True
 
         self.path_length = path_length
         self.step_rand = step_rand
@@ -73,24 +96,51 @@ class HamiltonianMC(ArrayStep):
             state = SamplerHist()
         self.state = state
 
-        super(HamiltonianMC, self).__init__(vars, [model.fastlogp, model.fastdlogp(vars)], **kwargs)
+        # log density and gradient at the last returned sample
+        self.logp0 = self.dlogp0 = None
 
-    def astep(self, q0, logp, dlogp):
-        H = Hamiltonian(logp, dlogp, self.potential)
+        shared = make_shared_replacements(vars, model)
+        self.logp_dlogp = model.logp_dlogp_function(vars, shared=shared)
+
+        super(HamiltonianMC, self).__init__(vars, shared, **kwargs)
+
+    def set_tuning(self, tune):
+        """Set the number of tuning draws of the next run, which gives the
+        schedule of the scaling adaptation."""
+        if self.adaptation is not None:
+            self.adaptation.set_tune(tune)
+
+    def astep(self, q0):
+        pot = self.potential
 
         e = self.step_rand(self.step_size)
         nstep = int(self.path_length / e)
 
-        p0 = H.pot.random()
+        # The cached log density and gradient are stale if another step method
+        # has changed the point since the last sample.
+        if self.logp0 is None or self.point_changed:
+            self.logp0, self.dlogp0 = self.logp_dlogp(q0)
 
-        q, p = leapfrog(H, q0, p0, nstep, e)
+        p0 = pot.random()
+
+        q, p, logp1, dlogp1 = leapfrog_logp(self.logp_dlogp, pot, q0, p0,
+                                            self.logp0, self.dlogp0, nstep, e)
         p = -p
 
-        mr = energy(H, q0, p0) - energy(H, q, p)
+        mr = -(self.logp0 - pot.energy(p0)) + (logp1 - pot.energy(p))
 
         self.state.metrops.append(mr)
 
-        return metrop_select(mr, q, q0)
+        q_new = metrop_select(mr, q, q0)
+        if q_new is q:
+            self.logp0, self.dlogp0 = logp1, dlogp1
+
+        if self.tune and self.adaptation is not None:
+            cov = self.adaptation.update(q_new)
+            if cov is not None:
+                self.potential.set_cov(cov)
+
+        return q_new
 
 
     @staticmethod
@@ -110,16 +160,29 @@ def energy(H, q, p):
         return -(H.logp(q) - H.pot.energy(p))
 
 def leapfrog(H, q, p, n, e):
-    _, dlogp, pot = H
+    def logp_dlogp(q):
+        return None, H.dlogp(q)
+
+    q, p, _, _ = leapfrog_logp(logp_dlogp, H.pot, q, p, None, H.dlogp(q), n, e)
+    return q, p
 
-    p = p - (e/2) * -dlogp(q)  # half momentum update
+def leapfrog_logp(logp_dlogp, pot, q, p, logp_q, dlogp_q, n, e):
+    """Leapfrog integration starting from the known log density `logp_q`
+    and gradient `dlogp_q` at `q`.
+
+    `logp_dlogp` returns the log density and its gradient in one call. Both
+    are returned for the final position, so that consecutive trajectories do
+    not have to evaluate them again.
+    """
+    p = p - (e/2) * -dlogp_q  # half momentum update
 
     for i in range(n):
         #alternate full variable and momentum updates
         q = q + e * pot.velocity(p)
+        logp_q, dlogp_q = logp_dlogp(q)
 
         if i != n - 1:
-            p = p - e * -dlogp(q)
+            p = p - e * -dlogp_q
 
-    p = p - (e/2) * -dlogp(q)  # do a half step momentum update to finish off
-    return q, p
+    p = p - (e/2) * -dlogp_q  # do a half step momentum update to finish off
+    return q, p, logp_q, dlogp_q
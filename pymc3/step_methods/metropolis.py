@@ -1,48 +1,64 @@
+import inspect
+
 from numpy.linalg import cholesky
 
 from .quadpotential import quad_potential
-from ..model import modelcontext
+from ..model import modelcontext, ValueGradFunction
 from ..theanof import inputvars
 from ..vartypes import discrete_types, bool_types
-from .arraystep import ArrayStepShared, ArrayStep, metrop_select, Competence
+from .arraystep import ArrayStepShared, metrop_select, Competence
+from .gibbs import elemwise_logpt
 from numpy.random import (normal, standard_cauchy, standard_exponential, poisson, random,
                         multivariate_normal, shuffle)
 from ..distributions import Bernoulli, Categorical
-from numpy import round, exp, copy, where, size, zeros, ones, atleast_1d, concatenate
-import theano
+from numpy import (round, exp, copy, where, size, shape, zeros, ones, atleast_1d,
+                   concatenate, diag, sqrt, log)
+import theano.tensor as tt
 
-from ..theanof import make_shared_replacements, join_nonshared_inputs, CallableTensor
+from ..theanof import make_shared_replacements
 
 
-__all__ = ['Metropolis', 'BinaryMetropolis', 'BinaryGibbsMetropolis', 'NormalProposal', 'CauchyProposal', 'LaplaceProposal', 'PoissonProposal', 'MultivariateNormalProposal']
+__all__ = ['Metropolis', 'DelayedAcceptanceMetropolis', 'AdaptiveMetropolis', 'BinaryMetropolis', 'BinaryGibbsMetropolis', 'NormalProposal', 'CauchyProposal', 'LaplaceProposal', 'PoissonProposal', 'MultivariateNormalProposal']
 
 # Available proposal distributions for Metropolis
 
 
 class Proposal(object):
+    """
+    Zero-mean proposal distribution parameterized by `s`
+
+    Calling a proposal returns one deviate of the shape of `s`, or a block
+    of `num_draws` of them stacked along the first axis.
+    """
+
     def __init__(self, s):
         self.s = s
 
+    def size(self, num_draws=None):
+        if num_draws is None:
+            return shape(self.s)
+        return (num_draws,) + shape(self.s)
+
 
 class NormalProposal(Proposal):
-    def __call__(self):
-        return normal(scale=self.s)
+    def __call__(self, num_draws=None):
+        return normal(scale=self.s, size=self.size(num_draws))
 
 
 class CauchyProposal(Proposal):
-    def __call__(self):
-        return standard_cauchy(size=size(self.s)) * self.s
+    def __call__(self, num_draws=None):
+        return standard_cauchy(size=self.size(num_draws)) * self.s
 
 
 class LaplaceProposal(Proposal):
-    def __call__(self):
-        size = size(self.s)
+    def __call__(self, num_draws=None):
+        size = self.size(num_draws)
         return (standard_exponential(size=size) - standard_exponential(size=size)) * self.s
 
 
 class PoissonProposal(Proposal):
-    def __call__(self):
-        return poisson(lam=self.s, size=size(self.s)) - self.s
+    def __call__(self, num_draws=None):
+        return poisson(lam=self.s, size=self.size(num_draws)) - self.s
 
 
 class MultivariateNormalProposal(Proposal):
@@ -50,6 +66,20 @@ class MultivariateNormalProposal(Proposal):
         return multivariate_normal(mean=zeros(self.s.shape[0]), cov=self.s, size=num_draws)
 
 
+_getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
+
+
+def _draws_blocks(proposal):
+    """Whether `proposal` can be called with a number of draws, proposals
+    that take no arguments are called once per draw."""
+    call = proposal if inspect.isfunction(proposal) else proposal.__call__
+    try:
+        spec = _getargspec(call)
+    except TypeError:
+        return False
+    return len(spec.args) > inspect.ismethod(call) or spec.varargs is not None
+
+
 class Metropolis(ArrayStepShared):
     """
     Metropolis-Hastings sampling step
@@ -63,12 +93,23 @@ class Metropolis(ArrayStepShared):
     proposal_dist : function
         Function that returns zero-mean deviates when parameterized with
         S (and n). Defaults to normal.
+    proposal_buffer : int
+        Number of proposal deviates drawn at once and consumed one per
+        step, if `proposal_dist` takes the number of draws. Defaults to 100.
     scaling : scalar or array
         Initial scale factor for proposal. Defaults to 1.
     tune : bool
         Flag for tuning. Defaults to True.
     tune_interval : int
         The frequency of tuning. Defaults to 100 iterations.
+    elemwise : bool
+        Propose all elements of a single variable at once and accept or
+        reject each element on its own, from the elementwise log-density of
+        the factors that depend on the variable. Only valid when the
+        elements are conditionally independent. Defaults to False.
+    beta : float
+        Inverse temperature, the log-probability is multiplied by beta.
+        Defaults to 1.
     model : PyMC Model
         Optional model for sampling step. Defaults to None (taken from context).
 
@@ -76,7 +117,8 @@ class Metropolis(ArrayStepShared):
     default_blocked = False
 
     def __init__(self, vars=None, S=None, proposal_dist=NormalProposal, scaling=1.,
-                 tune=True, tune_interval=100, model=None, **kwargs):
+                 tune=True, tune_interval=100, proposal_buffer=100, elemwise=False,
+                 beta=1., model=None, **kwargs):
 
         model = modelcontext(model)
 
@@ -87,11 +129,17 @@ class Metropolis(ArrayStepShared):
         if S is None:
             S = ones(sum(v.dsize for v in vars))
         self.proposal_dist = proposal_dist(S)
+        if not _draws_blocks(self.proposal_dist):
+            proposal_buffer = 1
+        self.proposal_buffer = proposal_buffer
+        self.proposal_samples_array = None
+        self.proposal_sample = proposal_buffer
         self.scaling = atleast_1d(scaling)
         self.tune = tune
         self.tune_interval = tune_interval
         self.steps_until_tune = tune_interval
         self.accepted = 0
+        self.beta = beta
 
         # Determine type of variables
         self.discrete = concatenate([[v.dtype in discrete_types ] * (v.dsize or 1) for v in vars])
@@ -99,11 +147,23 @@ class Metropolis(ArrayStepShared):
         self.all_discrete = self.discrete.all()
 
         shared = make_shared_replacements(vars, model)
-        self.delta_logp = delta_logp(model.logpt, vars, shared)
+        self.elemwise = elemwise
+        if elemwise:
+            if len(vars) != 1:
+                raise ValueError(
+                    'Elementwise Metropolis needs a single variable')
+            self.logp = ValueGradFunction(
+                tt.flatten(elemwise_logpt(model, vars[0])), vars, shared,
+                grad=False)
+        else:
+            self.logp = model.logp_dlogp_function(vars, shared=shared, grad=False,
+                                                  conditional=True)
+        # logp of the current state, reused until the point changes
+        self.logp0 = None
         super(Metropolis, self).__init__(vars, shared)
 
-    def astep(self, q0):
-
+    def propose(self, q0):
+        """Tune the scaling if due and return a proposal from q0."""
         if not self.steps_until_tune and self.tune:
             # Tune scaling parameter
             self.scaling = tune(
@@ -111,26 +171,44 @@ class Metropolis(ArrayStepShared):
             # Reset counter
             self.steps_until_tune = self.tune_interval
             self.accepted = 0
+        self.steps_until_tune -= 1
 
-        delta = self.proposal_dist() * self.scaling
+        if self.proposal_buffer == 1:
+            delta = self.proposal_dist() * self.scaling
+        else:
+            if self.proposal_sample == self.proposal_buffer:
+                # Refill the buffer of proposal deviates
+                self.proposal_samples_array = self.proposal_dist(self.proposal_buffer)
+                self.proposal_sample = 0
+
+            delta = self.proposal_samples_array[self.proposal_sample] * self.scaling
+            self.proposal_sample += 1
 
         if self.any_discrete:
             if self.all_discrete:
-                delta = round(delta, 0).astype(int)
-                q0 = q0.astype(int)
-                q = (q0 + delta).astype(int)
+                delta = round(delta, 0)
             else:
-                delta[self.discrete] = round(delta[self.discrete], 0).astype(int)
-                q = q0 + delta
-        else:
-            q = q0 + delta
+                delta[self.discrete] = round(delta[self.discrete], 0)
+        return q0 + delta
 
-        q_new = metrop_select(self.delta_logp(q, q0), q, q0)
+    def astep(self, q0):
+        if self.logp0 is None or self.point_changed:
+            self.logp0 = self.logp(q0)
 
-        if q_new is q:
-            self.accepted += 1
+        q = self.propose(q0)
+        logp = self.logp(q)
 
-        self.steps_until_tune -= 1
+        if self.elemwise:
+            accept = log(random(q.shape)) < self.beta * (logp - self.logp0)
+            q_new = where(accept, q, q0)
+            self.accepted += accept.mean()
+            self.logp0 = where(accept, logp, self.logp0)
+        else:
+            q_new = metrop_select(self.beta * (logp - self.logp0), q, q0)
+
+            if q_new is q:
+                self.accepted += 1
+                self.logp0 = logp
 
         return q_new
 
@@ -141,6 +219,208 @@ class Metropolis(ArrayStepShared):
         return Competence.INCOMPATIBLE
 
 
+class DelayedAcceptanceMetropolis(Metropolis):
+    """
+    Metropolis-Hastings sampling step that screens proposals with a cheap
+    approximation of the log-probability before evaluating the full one
+    (Christen & Fox 2005)
+
+    A proposal is first accepted or rejected on the cheap log-probability,
+    the prior of the variables plus `approx_logp` if given. Only proposals
+    that pass are evaluated on the full log-probability, in a second stage
+    that corrects for the approximation, so that the chain still samples
+    the exact posterior.
+
+    Parameters
+    ----------
+    vars : list
+        List of variables for sampler
+    approx_logp : theano variable
+        Cheap approximation of the log-likelihood of vars. Defaults to None,
+        which screens on the prior only.
+    S : standard deviation or covariance matrix
+        Some measure of variance to parameterize proposal distribution
+    proposal_dist : function
+        Function that returns zero-mean deviates when parameterized with
+        S (and n). Defaults to normal.
+    scaling : scalar or array
+        Initial scale factor for proposal. Defaults to 1.
+    tune : bool
+        Flag for tuning. Defaults to True.
+    tune_interval : int
+        The frequency of tuning. Defaults to 100 iterations.
+    model : PyMC Model
+        Optional model for sampling step. Defaults to None (taken from context).
+    """
+    default_blocked = True
+
+    def __init__(self, vars=None, approx_logp=None, S=None,
+                 proposal_dist=NormalProposal, scaling=1., tune=True,
+                 tune_interval=100, model=None, **kwargs):
+        model = modelcontext(model)
+
+        if vars is None:
+            vars = model.vars
+        vars = inputvars(vars)
+
+        super(DelayedAcceptanceMetropolis, self).__init__(
+            vars, S=S, proposal_dist=proposal_dist, scaling=scaling,
+            tune=tune, tune_interval=tune_interval, model=model, **kwargs)
+        if self.elemwise:
+            raise ValueError('Delayed acceptance needs a blocked step')
+
+        cheap_logp = tt.add(*[tt.sum(var.logpt) for var in vars])
+        if approx_logp is not None:
+            cheap_logp = cheap_logp + tt.sum(approx_logp)
+        shared = {model[name]: share for name, share in self.shared.items()}
+        self.cheap_logp = ValueGradFunction(
+            cheap_logp, vars, shared, grad=False, on_unused_input='ignore')
+        self.cheap_logp0 = None
+        self.screened = 0
+
+    def astep(self, q0):
+        if self.logp0 is None or self.point_changed:
+            self.logp0 = self.logp(q0)
+            self.cheap_logp0 = self.cheap_logp(q0)
+
+        q = self.propose(q0)
+
+        # First stage on the cheap log-probability
+        cheap_logp = self.cheap_logp(q)
+        delta_cheap = cheap_logp - self.cheap_logp0
+        if not log(random()) < self.beta * delta_cheap:
+            self.screened += 1
+            return q0
+
+        # Second stage on the full log-probability, corrected for the first
+        logp = self.logp(q)
+        q_new = metrop_select(self.beta * (logp - self.logp0 - delta_cheap),
+                              q, q0)
+        if q_new is q:
+            self.accepted += 1
+            self.logp0 = logp
+            self.cheap_logp0 = cheap_logp
+        return q_new
+
+    @staticmethod
+    def competence(var):
+        return Competence.INCOMPATIBLE
+
+
+class AdaptiveMetropolis(ArrayStepShared):
+    """
+    Metropolis-Hastings sampling step with a multivariate normal proposal
+    whose covariance adapts to the chain (Haario et al. 2001)
+
+    While tuning, the running mean and covariance of the visited states are
+    updated after every step. The Cholesky factor of the proposal covariance
+    is kept up to date with a rank-one update instead of being refactored.
+
+    Parameters
+    ----------
+    vars : list
+        List of variables for sampler
+    S : array
+        Initial covariance matrix of the proposal, or its diagonal.
+        Defaults to the identity.
+    scaling : scalar
+        Scale factor for the proposal covariance. Defaults to 2.38**2 / n,
+        with n the number of dimensions.
+    cov_weight : int
+        Number of draws the initial covariance counts as in the running
+        estimate. Defaults to 10.
+    tune : bool
+        Flag for adapting the covariance. Defaults to True.
+    proposal_buffer : int
+        Number of normal deviates drawn at once and consumed one per step.
+        Defaults to 100.
+    model : PyMC Model
+        Optional model for sampling step. Defaults to None (taken from context).
+
+    """
+
+    def __init__(self, vars=None, S=None, scaling=None, cov_weight=10,
+                 tune=True, proposal_buffer=100, model=None, **kwargs):
+
+        model = modelcontext(model)
+
+        if vars is None:
+            vars = model.vars
+        vars = inputvars(vars)
+
+        if any(v.dtype in discrete_types for v in vars):
+            raise ValueError(
+                'All variables must be continuous for AdaptiveMetropolis')
+
+        n = sum(v.dsize for v in vars)
+        if S is None:
+            S = ones(n)
+        S = atleast_1d(S).astype(float)
+        if S.ndim == 1:
+            S = diag(S)
+        if scaling is None:
+            scaling = 2.38 ** 2 / n
+
+        self.scaling = scaling
+        self.tune = tune
+        self.accepted = 0
+
+        # Running mean and Cholesky factor of the covariance of the visited
+        # states, with S counted as cov_weight draws around the first state
+        self.mean = None
+        self.count = cov_weight
+        self.chol = cholesky(S)
+
+        self.proposal_dist = NormalProposal(ones(n))
+        self.proposal_buffer = proposal_buffer
+        self.proposal_samples_array = None
+        self.proposal_sample = proposal_buffer
+
+        shared = make_shared_replacements(vars, model)
+        self.logp = model.logp_dlogp_function(vars, shared=shared, grad=False,
+                                              conditional=True)
+        self.logp0 = None
+        super(AdaptiveMetropolis, self).__init__(vars, shared)
+
+    def astep(self, q0):
+        if self.mean is None:
+            self.mean = q0.copy()
+
+        if self.logp0 is None or self.point_changed:
+            self.logp0 = self.logp(q0)
+
+        if self.proposal_sample == self.proposal_buffer:
+            self.proposal_samples_array = self.proposal_dist(self.proposal_buffer)
+            self.proposal_sample = 0
+
+        z = self.proposal_samples_array[self.proposal_sample]
+        self.proposal_sample += 1
+
+        q = q0 + sqrt(self.scaling) * self.chol.dot(z)
+
+        logp = self.logp(q)
+        q_new = metrop_select(logp - self.logp0, q, q0)
+
+        if q_new is q:
+            self.accepted += 1
+            self.logp0 = logp
+
+        if self.tune:
+            self.update(q_new)
+
+        return q_new
+
+    def update(self, q):
+        """Add the state q to the running mean and covariance."""
+        self.count += 1
+        n = self.count
+        delta = q - self.mean
+        self.mean += delta / n
+        # C_n = (n - 1) / n * (C_{n-1} + delta delta^T / n)
+        cholesky_update(self.chol, delta / sqrt(n))
+        self.chol *= sqrt((n - 1.) / n)
+
+
 def tune(scale, acc_rate):
     """
     Tunes the scaling parameter for the proposal distribution
@@ -180,7 +460,7 @@ def tune(scale, acc_rate):
     return scale
 
 
-class BinaryMetropolis(ArrayStep):
+class BinaryMetropolis(ArrayStepShared):
     """Metropolis-Hastings optimized for binary variables
     
     Parameters
@@ -201,6 +481,7 @@ class BinaryMetropolis(ArrayStep):
     def __init__(self, vars, scaling=1., tune=True, tune_interval=100, model=None):
 
         model = modelcontext(model)
+        vars = inputvars(vars)
 
         self.scaling = scaling
         self.tune = tune
@@ -212,9 +493,15 @@ class BinaryMetropolis(ArrayStep):
             raise ValueError(
                 'All variables must be Bernoulli for BinaryMetropolis')
 
-        super(BinaryMetropolis, self).__init__(vars, [model.fastlogp])
+        shared = make_shared_replacements(vars, model)
+        self.logp = model.logp_dlogp_function(vars, shared=shared, grad=False,
+                                              conditional=True)
+        self.logp0 = None
+        super(BinaryMetropolis, self).__init__(vars, shared)
 
-    def astep(self, q0, logp):
+    def astep(self, q0):
+        if self.logp0 is None or self.point_changed:
+            self.logp0 = self.logp(q0)
 
         # Convert adaptive_scale_factor to a jump probability
         p_jump = 1. - .5 ** self.scaling
@@ -225,7 +512,10 @@ class BinaryMetropolis(ArrayStep):
         switch_locs = (rand_array < p_jump)
         q[switch_locs] = True - q[switch_locs]
 
-        q_new = metrop_select(logp(q) - logp(q0), q, q0)
+        logp = self.logp(q)
+        q_new = metrop_select(logp - self.logp0, q, q0)
+        if q_new is q:
+            self.logp0 = logp
 
         return q_new
 
@@ -242,12 +532,41 @@ class BinaryMetropolis(ArrayStep):
             return Competence.COMPATIBLE
         return Competence.INCOMPATIBLE
 
-class BinaryGibbsMetropolis(ArrayStep):
-    """Metropolis-Hastings optimized for binary variables"""
+class BinaryGibbsMetropolis(ArrayStepShared):
+    """
+    Metropolis-Hastings optimized for binary variables
+
+    By default every element is flipped in turn, and each flip is accepted
+    or rejected on its own against the cached log-density of the current
+    state. Every flip evaluates the log-density of all factors that depend
+    on the variables, so a sweep costs one evaluation per element.
+
+    Opting in with `elemwise` computes the log-odds of all flips from the
+    factors of each element alone, in one evaluation per sweep. This is
+    only valid when the elements are conditionally independent, which is
+    not checked.
 
-    def __init__(self, vars, order='random', model=None):
+    Parameters
+    ----------
+    vars : list
+        List of variables for sampler
+    order : 'random' or other
+        Elements are updated in random order if 'random', otherwise in
+        sequence. Defaults to 'random'.
+    elemwise : bool
+        Flip all elements of a single variable at once, from the elementwise
+        log-density of the factors that depend on the variable. Only valid
+        when the elements are conditionally independent and no Potential
+        depends on the variable. Defaults to False.
+    model : PyMC Model
+        Optional model for sampling step. Defaults to None (taken from context).
+
+    """
+
+    def __init__(self, vars, order='random', elemwise=False, model=None):
 
         model = modelcontext(model)
+        vars = inputvars(vars)
 
         self.dim = sum(v.dsize for v in vars)
         self.order = order
@@ -256,22 +575,50 @@ class BinaryGibbsMetropolis(ArrayStep):
             raise ValueError(
                 'All variables must be Bernoulli for BinaryGibbsMetropolis')
 
-        super(BinaryGibbsMetropolis, self).__init__(vars, [model.fastlogp])
+        shared = make_shared_replacements(vars, model)
+        self.elemwise = elemwise
+        if elemwise:
+            if len(vars) != 1:
+                raise ValueError(
+                    'Elementwise BinaryGibbsMetropolis needs a single variable')
+            self.logp = ValueGradFunction(
+                tt.flatten(elemwise_logpt(model, vars[0])), vars, shared,
+                grad=False)
+        else:
+            self.logp = model.logp_dlogp_function(vars, shared=shared, grad=False,
+                                                  conditional=True)
+        self.logp0 = None
+        super(BinaryGibbsMetropolis, self).__init__(vars, shared)
+
+    def astep(self, q0):
+        if self.logp0 is None or self.point_changed:
+            self.logp0 = self.logp(q0)
+
+        q = copy(q0)
+
+        if self.elemwise:
+            # Log-density of every element flipped, all at once
+            logp = self.logp(1 - q)
+            accept = log(random(q.shape)) < logp - self.logp0
+            q[accept] = 1 - q[accept]
+            self.logp0 = where(accept, logp, self.logp0)
+            return q
 
-    def astep(self, q0, logp):
         order = list(range(self.dim))
         if self.order == 'random':
             shuffle(order)
 
-        q_prop = copy(q0)
-        q_cur = copy(q0)
-
+        logp0 = self.logp0
         for idx in order:
-            q_prop[idx] = True - q_prop[idx]
-            q_cur = metrop_select(logp(q_prop) - logp(q_cur), q_prop, q_cur)
-            q_prop = copy(q_cur)
+            q[idx] = 1 - q[idx]
+            logp = self.logp(q)
+            if log(random()) < logp - logp0:
+                logp0 = logp
+            else:
+                q[idx] = 1 - q[idx]
+        self.logp0 = logp0
 
-        return q_cur
+        return q
 
     @staticmethod
     def competence(var):
@@ -286,14 +633,18 @@ class BinaryGibbsMetropolis(ArrayStep):
             return Competence.IDEAL
         return Competence.INCOMPATIBLE
 
-def delta_logp(logp, vars, shared):
-    [logp0], inarray0 = join_nonshared_inputs([logp], vars, shared)
 
-    tensor_type = inarray0.type
-    inarray1 = tensor_type('inarray1')
-
-    logp1 = CallableTensor(logp0)(inarray1)
-
-    f = theano.function([inarray1, inarray0], logp1 - logp0)
-    f.trust_input = True
-    return f
+def cholesky_update(L, x):
+    """
+    Update the lower triangular Cholesky factor L of A in place to the
+    factor of A + x x^T, in O(n^2) operations.
+    """
+    x = x.copy()
+    for k in range(len(x)):
+        r = sqrt(L[k, k] ** 2 + x[k] ** 2)
+        c = r / L[k, k]
+        s = x[k] / L[k, k]
+        L[k, k] = r
+        L[k + 1:, k] = (L[k + 1:, k] + s * x[k + 1:]) / c
+        x[k + 1:] = c * x[k + 1:] - s * L[k + 1:, k]
+    return L
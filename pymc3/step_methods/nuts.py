@@ -1,10 +1,11 @@
-from .quadpotential import quad_potential
+from .quadpotential import quad_potential, quad_potential_adapt, WindowedAdaptation
 from .arraystep import ArrayStepShared, ArrayStep, SamplerHist, Competence
 from ..model import modelcontext, Point
 from ..vartypes import continuous_types
-from numpy import exp, log, array
+from numpy import exp, log, array, isnan, inf
+import numpy as np
 from numpy.random import uniform
-from .hmc import leapfrog, Hamiltonian, bern, energy
+from .hmc import leapfrog_logp, bern
 from ..tuning import guess_scaling
 import theano
 from ..theanof import (make_shared_replacements, join_nonshared_inputs, CallableTensor,
@@ -30,6 +31,11 @@ class NUTS(ArrayStepShared):
                  gamma=0.05,
                  k=0.75,
                  t0=10,
+                 max_treedepth=10,
+                 adapt_scaling=None,
+                 adapt_window=25,
+                 adapt_buffer=75,
+                 adapt_term_buffer=50,
                  model=None,
                  profile=False,**kwargs):
         """
@@ -53,6 +59,22 @@ class NUTS(ArrayStepShared):
                 scaling of speed of adaptation
             t0 : int, default 10
                 slows inital adapatation
+            max_treedepth : int, default 10
+                maximum depth of the trajectory tree, limits the number of
+                leapfrog steps per sample to 2**max_treedepth - 1
+            adapt_scaling : {None, 'diag', 'dense'}
+                If set, the scaling is adapted to the sample covariance of the
+                tuning draws, estimating either its diagonal or the full matrix
+            adapt_window : int, default 25
+                Number of draws in the first adaptation window, later windows
+                double in size
+            adapt_buffer : int, default 75
+                Number of initial tuning draws not used for adaptation
+            adapt_term_buffer : int, default 50
+                Number of final tuning draws not used for adaptation, which
+                adapt the step size to the last estimate of the scaling. The
+                scaling is only adapted when the number of tuning draws is
+                given to `sample`.
             model : Model
             profile : bool or ProfileStats
                 sets the functions to be profiled
@@ -76,7 +98,15 @@ class NUTS(ArrayStepShared):
         self.step_size = step_scale / n**(1/4.)
 
 
-        self.potential = quad_potential(scaling, is_cov, as_cov=False)
+        if adapt_scaling is None:
+            self.potential = quad_potential(scaling, is_cov, as_cov=False)
+            self.adaptation = None
+        else:
+            dense = adapt_scaling == 'dense'
+            self.potential = quad_potential_adapt(scaling, is_cov, dense)
+            self.adaptation = WindowedAdaptation(n, dense, adapt_window, adapt_buffer,
+                                                 adapt_term_buffer)
+        self.tune = True
 
         if state is None:
             state = SamplerHist()
@@ -92,43 +122,67 @@ class NUTS(ArrayStepShared):
         self.u = log(self.step_size*10)
         self.m = 1
 
+        self.max_treedepth = max_treedepth
+        self.tree = Tree(n, max_treedepth)
+        self.tree_depth = 0
 
 
         shared = make_shared_replacements(vars, model)
+        self.logp_dlogp = model.logp_dlogp_function(vars, shared=shared, profile=profile)
         self.leapfrog1_dE = leapfrog1_dE(model.logpt, vars, shared, self.potential, profile=profile)
 
         super(NUTS, self).__init__(vars, shared, **kwargs)
 
+    def set_tuning(self, tune):
+        """Set the number of tuning draws of the next run, which gives the
+        schedule of the scaling adaptation."""
+        if self.adaptation is not None:
+            self.adaptation.set_tune(tune)
+
     def astep(self, q0):
         H = self.leapfrog1_dE #Hamiltonian(self.logp, self.dlogp, self.potential)
         Emax = self.Emax
         e = self.step_size
 
+        tree = self.tree
+        # The log density and gradient kept in the tree belong to the last
+        # sample, they are stale if another step method has changed the point.
+        if tree.logp is None or self.point_changed:
+            logp0, dlogp0 = self.logp_dlogp(q0)
+        else:
+            logp0, dlogp0 = tree.logp, tree.dlogp
+
         p0 = self.potential.random()
-        u = uniform()
-        q = qn = qp = q0
-        p = pn = pp = p0
+        E0 = array(-logp0 + self.potential.energy(p0))
+        logu = log(uniform())
+
+        tree.reset(q0, p0, logp0, dlogp0)
 
         n, s, j = 1, 1, 0
 
-        while s == 1:
+        while s == 1 and j < self.max_treedepth:
             v = bern(.5) * 2 - 1
 
-            if v == -1:
-                qn, pn, _, _, q1, n1, s1, a, na = buildtree(H, qn, pn, u, v, j, e, Emax, q0, p0)
-            else:
-                _, _, qp, pp, q1, n1, s1, a, na = buildtree(H, qp, pp, u, v, j, e, Emax, q0, p0)
+            n1, s1, a, na = tree.extend(H, v, j, e, logu, Emax, E0)
 
             if s1 == 1 and bern(min(1, n1*1./n)):
-                q = q1
+                tree.accept()
 
             n = n + n1
 
-            span = qp - qn
-            s = s1 * (span.dot(pn) >= 0) * (span.dot(pp) >= 0)
+            s = s1 * tree.no_uturn()
             j = j + 1
 
-        p = -p
+        self.tree_depth = j
+
+        if self.tune and self.adaptation is not None:
+            cov = self.adaptation.update(tree.q)
+            if cov is not None:
+                self.potential.set_cov(cov)
+                # restart step size adaptation for the new scaling
+                self.Hbar = 0
+                self.u = log(self.step_size*10)
+                self.m = 1
 
         w = 1./(self.m+self.t0)
         self.Hbar = (1 - w) * self.Hbar + w*(self.target_accept - a*1./na)
@@ -136,7 +190,7 @@ class NUTS(ArrayStepShared):
         self.step_size = exp(self.u - (self.m**.5/self.gamma)*self.Hbar)
         self.m += 1
 
-        return q
+        return tree.q.copy()
 
     @staticmethod
     def competence(var):
@@ -145,37 +199,132 @@ class NUTS(ArrayStepShared):
         return Competence.INCOMPATIBLE
 
 
-def buildtree(H, q, p, u, v, j, e, Emax, q0, p0):
-    if j == 0:
-        leapfrog1_dE = H
-        q1, p1, dE = leapfrog1_dE(q, p, array(v*e), q0, p0)
+class Tree(object):
+    """Iterative trajectory builder for NUTS.
 
-        n1 = int(log(u) + dE <= 0)
-        s1 = int(log(u) + dE < Emax)
-        return q1, p1, q1, p1, q1, n1, s1, min(1, exp(-dE)), 1
-    else:
-        qn, pn, qp, pp, q1, n1, s1, a1, na1 = buildtree(H, q, p, u, v, j - 1, e, Emax, q0, p0)
-        if s1 == 1:
-            if v == -1:
-                qn, pn, _, _, q11, n11, s11, a11, na11 = buildtree(H, qn, pn, u, v, j - 1, e, Emax, q0, p0)
+    Keeps the state of the trajectory in buffers that are allocated once,
+    instead of recursing over subtrees and returning new arrays at every
+    level. The left- and rightmost states of all unfinished subtrees are
+    stored in `max_treedepth` checkpoint slots, which is sufficient to check
+    the U-turn criterion of every subtree as soon as its last leaf is built.
+
+    Parameters
+    ----------
+    n : int
+        Dimension of the sampling space
+    max_treedepth : int
+        Maximum depth of a trajectory
+    """
+    def __init__(self, n, max_treedepth):
+        # position, momentum and log density gradient at both edges
+        self.qn, self.pn, self.dlogpn = np.empty((3, n))
+        self.qp, self.pp, self.dlogpp = np.empty((3, n))
+        # current sample and proposal of the subtree being built
+        self.q, self.dlogp = np.empty((2, n))
+        self.q1, self.dlogp1 = np.empty((2, n))
+        self.logp = self.logp1 = None
+        self.q_ckpts = np.empty((max_treedepth, n))
+        self.p_ckpts = np.empty((max_treedepth, n))
+
+    def reset(self, q0, p0, logp0, dlogp0):
+        """Start a new trajectory at (q0, p0)."""
+        for buf in (self.qn, self.qp, self.q):
+            buf[:] = q0
+        for buf in (self.pn, self.pp):
+            buf[:] = p0
+        for buf in (self.dlogpn, self.dlogpp, self.dlogp):
+            buf[:] = dlogp0
+        self.logp = logp0
+
+    def extend(self, H, v, j, e, logu, Emax, E0):
+        """Double the trajectory by building a subtree of depth `j` in
+        direction `v`.
+
+        Leaves are generated one at a time. The proposal of the subtree is
+        drawn uniformly from its leaves inside the slice, and building stops
+        at the first divergent leaf or U-turning subtree.
+
+        Returns
+        -------
+        n1 : number of leaves inside the slice
+        s1 : 1 if the subtree is valid, else 0
+        a1, na1 : sum of acceptance probabilities and number of leaves
+        """
+        if v == -1:
+            q, p, dlogp = self.qn, self.pn, self.dlogpn
+        else:
+            q, p, dlogp = self.qp, self.pp, self.dlogpp
+        ve = array(v*e)
+
+        n1, a1, na1 = 0, 0., 0
+        for i in range(2**j):
+            q1, p1, logp1, dlogp1, dE = H(q, p, dlogp, ve, E0)
+            if isnan(dE):
+                # an undefined energy counts as a divergence
+                dE = inf
+            q[:] = q1
+            p[:] = p1
+            dlogp[:] = dlogp1
+
+            a1 += min(1, exp(-dE))
+            na1 += 1
+
+            if logu + dE <= 0:
+                n1 += 1
+                if bern(1./n1):
+                    self.q1[:] = q
+                    self.dlogp1[:] = dlogp
+                    self.logp1 = logp1
+            if logu + dE >= Emax:
+                return n1, 0, a1, na1
+
+            if i % 2 == 0:
+                k = ckpt_idxs(i)[1]
+                self.q_ckpts[k] = q
+                self.p_ckpts[k] = p
             else:
-                _, _, qp, pp, q11, n11, s11, a11, na11 = buildtree(H, qp, pp, u, v, j - 1, e, Emax, q0, p0)
+                kmin, kmax = ckpt_idxs(i)
+                for k in range(kmax, kmin - 1, -1):
+                    if not no_uturn(v*(q - self.q_ckpts[k]), self.p_ckpts[k], p):
+                        return n1, 0, a1, na1
 
-            if bern(n11*1./(max(n1 + n11, 1))):
-                q1 = q11
+        return n1, 1, a1, na1
 
-            a1 = a1 + a11
-            na1 = na1 + na11
+    def accept(self):
+        """Take the proposal of the last subtree as the current sample."""
+        self.q[:] = self.q1
+        self.dlogp[:] = self.dlogp1
+        self.logp = self.logp1
 
-            span = qp - qn
-            s1 = s11 * (span.dot(pn) >= 0) * (span.dot(pp) >= 0)
-            n1 = n1 + n11
-        return qn, pn, qp, pp, q1, n1, s1, a1, na1
-    return
+    def no_uturn(self):
+        """Check the U-turn criterion over the whole trajectory."""
+        return no_uturn(self.qp - self.qn, self.pn, self.pp)
+
+
+def no_uturn(span, pn, pp):
+    return int(span.dot(pn) >= 0 and span.dot(pp) >= 0)
+
+
+def ckpt_idxs(i):
+    """Checkpoint slots for leaf `i` of a subtree.
+
+    The subtrees that end at an odd leaf `i` start at the checkpoints
+    `kmin, ..., kmax`; an even leaf is stored at `kmax`.
+    """
+    kmax = bin(i >> 1).count('1')
+    ntrailing = 0
+    while i & 1:
+        i >>= 1
+        ntrailing += 1
+    return kmax - ntrailing + 1, kmax
 
 
 def leapfrog1_dE(logp, vars, shared, pot, profile):
     """Computes a theano function that computes one leapfrog step and the energy difference between the beginning and end of the trajectory.
+
+    The gradient at the starting position and the initial energy are passed in,
+    so that they do not need to be recomputed on every step.
+
     Parameters
     ----------
     logp : TensorVariable
@@ -186,32 +335,35 @@ def leapfrog1_dE(logp, vars, shared, pot, profile):
 
     Returns
     -------
-    theano function which returns
-    q_new, p_new, delta_E
+    theano function which takes
+    q, p, dlogp(q), e, E0
+    and returns
+    q_new, p_new, logp(q_new), dlogp(q_new), delta_E
     """
     dlogp = gradient(logp, vars)
     (logp, dlogp), q = join_nonshared_inputs([logp, dlogp], vars, shared)
     logp = CallableTensor(logp)
     dlogp = CallableTensor(dlogp)
 
-    H = Hamiltonian(logp, dlogp, pot)
+    def logp_dlogp(q):
+        return logp(q), dlogp(q)
 
     p = tt.dvector('p')
     p.tag.test_value = q.tag.test_value
 
-    q0 = tt.dvector('q0')
-    q0.tag.test_value = q.tag.test_value
-    p0 = tt.dvector('p0')
-    p0.tag.test_value = p.tag.test_value
+    dlogp0 = tt.dvector('dlogp0')
+    dlogp0.tag.test_value = q.tag.test_value
+
+    E0 = tt.dscalar('E0')
+    E0.tag.test_value = 0
 
     e = tt.dscalar('e')
     e.tag.test_value = 1
 
-    q1, p1 = leapfrog(H, q, p, 1, e)
-    E = energy(H, q1, p1)
-    E0 = energy(H, q0, p0)
+    q1, p1, logp1, dlogp1 = leapfrog_logp(logp_dlogp, pot, q, p, None, dlogp0, 1, e)
+    E = -(logp1 - pot.energy(p1))
     dE = E - E0
 
-    f = theano.function([q, p, e, q0, p0], [q1, p1, dE], profile=profile)
+    f = theano.function([q, p, dlogp0, e, E0], [q1, p1, logp1, dlogp1, dE], profile=profile)
     f.trust_input = True
     return f
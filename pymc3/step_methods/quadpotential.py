@@ -5,9 +5,13 @@ from scipy.linalg import cholesky, cho_solve
 from scipy.sparse import issparse
 
 import numpy as np
+import theano
+import theano.tensor as tt
 
 __all__ = ['quad_potential', 'ElemWiseQuadPotential', 'QuadPotential',
-           'QuadPotential_Inv', 'isquadpotential']
+           'QuadPotential_Inv', 'isquadpotential', 'quad_potential_adapt',
+           'ElemWiseQuadPotentialAdapt', 'QuadPotentialAdapt',
+           'WindowedAdaptation']
 
 def quad_potential(C, is_cov, as_cov):
     """
@@ -45,6 +49,34 @@ def quad_potential(C, is_cov, as_cov):
             return QuadPotential_Inv(C)
 
 
+def quad_potential_adapt(C, is_cov, dense):
+    """
+    Parameters
+    ----------
+        C : arraylike, 1 <= ndim <= 2
+            initial scaling matrix for the potential
+            vector treated as diagonal matrix
+        is_cov : Boolean
+            whether C is provided as a covariance matrix or hessian
+        dense : Boolean
+            whether to adapt the full matrix or only its diagonal
+
+    Returns
+    -------
+        q : Quadpotential with a settable covariance
+    """
+    partial_check_positive_definite(C)
+    if C.ndim == 1:
+        cov = C if is_cov else 1. / C
+    else:
+        cov = C if is_cov else np.linalg.inv(C)
+
+    if dense:
+        return QuadPotentialAdapt(cov if cov.ndim == 2 else np.diag(cov))
+    else:
+        return ElemWiseQuadPotentialAdapt(cov if cov.ndim == 1 else np.diag(cov))
+
+
 def partial_check_positive_definite(C):
     """Simple but partial check for Positive Definiteness"""
     if C.ndim == 1:
@@ -122,6 +154,164 @@ class QuadPotential(object):
 
     __call__ = random
 
+class ElemWiseQuadPotentialAdapt(ElemWiseQuadPotential):
+    """ElemWiseQuadPotential whose diagonal covariance can be changed
+    after compiling functions that use it.
+
+    The diagonal is mirrored in a shared variable, which is used when the
+    potential is applied to theano variables.
+    """
+    def __init__(self, v):
+        super(ElemWiseQuadPotentialAdapt, self).__init__(v)
+        self.v_shared = theano.shared(v, 'potential_v')
+
+    def set_cov(self, v):
+        super(ElemWiseQuadPotentialAdapt, self).__init__(v)
+        self.v_shared.set_value(v)
+
+    def velocity(self, x):
+        if isinstance(x, tt.Variable):
+            return self.v_shared * x
+        return self.v * x
+
+    def energy(self, x):
+        return .5 * x.dot(self.velocity(x))
+
+
+class QuadPotentialAdapt(QuadPotential):
+    """QuadPotential whose covariance can be changed after compiling
+    functions that use it.
+
+    The covariance is mirrored in a shared variable, which is used when the
+    potential is applied to theano variables.
+    """
+    def __init__(self, A):
+        super(QuadPotentialAdapt, self).__init__(A)
+        self.A_shared = theano.shared(A, 'potential_A')
+
+    def set_cov(self, A):
+        super(QuadPotentialAdapt, self).__init__(A)
+        self.A_shared.set_value(A)
+
+    def velocity(self, x):
+        if isinstance(x, tt.Variable):
+            return tt.dot(self.A_shared, x)
+        return self.A.dot(x)
+
+    def energy(self, x):
+        return .5 * x.dot(self.velocity(x))
+
+
+class WindowedAdaptation(object):
+    """Estimates the covariance of the sampled distribution over a sequence
+    of tuning windows, as in Stan.
+
+    The first `buffer` tuning draws are discarded. After that the sample
+    (co)variance is accumulated over windows that double in size, starting
+    with `window` draws. At the end of every window the regularized estimate
+    is returned and accumulation starts over, so that each estimate only
+    depends on draws taken with the previous one. The last window is
+    stretched to end `term_buffer` draws before the end of tuning, which
+    leaves these draws to adapt the step size to the last estimate. If
+    tuning is too short for this schedule, 15% of the draws are used for
+    the initial buffer, 10% for the terminal buffer and the rest for one
+    window.
+
+    Nothing is estimated until `set_tune` is called with the number of
+    tuning draws.
+
+    Parameters
+    ----------
+    n : int
+        Dimension of the sampling space
+    dense : bool
+        Estimate the full covariance matrix instead of its diagonal
+    window : int
+        Number of draws in the first window
+    buffer : int
+        Number of initial draws not used for estimation
+    term_buffer : int
+        Number of final tuning draws not used for estimation
+    """
+    def __init__(self, n, dense=False, window=25, buffer=75, term_buffer=50):
+        self.n = n
+        self.dense = dense
+        self.init_window = window
+        self.init_buffer = buffer
+        self.term_buffer = term_buffer
+        self.set_tune(None)
+
+    def set_tune(self, tune):
+        """Start over with the schedule for `tune` tuning draws, or without
+        estimation if `tune` is None."""
+        self.tune = tune
+        self.draws = 0
+        self.window = self.init_window
+        self.buffer = self.init_buffer
+        self.end = 0
+        if tune is not None:
+            term_buffer = self.term_buffer
+            if tune < self.buffer + self.window + term_buffer:
+                self.buffer = int(.15 * tune)
+                term_buffer = int(.1 * tune)
+                self.window = tune - self.buffer - term_buffer
+            self.end = tune - term_buffer
+        self.set_window_end(self.buffer)
+        self.reset()
+
+    def set_window_end(self, start):
+        self.window_end = start + self.window
+        if self.window_end + 2 * self.window > self.end:
+            self.window_end = self.end
+
+    def reset(self):
+        self.count = 0
+        self.mean = np.zeros(self.n)
+        if self.dense:
+            self.m2 = np.zeros((self.n, self.n))
+        else:
+            self.m2 = np.zeros(self.n)
+
+    def update(self, q):
+        """Add a draw.
+
+        Returns
+        -------
+        The covariance estimate if `q` ends a window, else None
+        """
+        self.draws += 1
+        if self.draws <= self.buffer or self.draws > self.end:
+            return None
+
+        # Welford's online algorithm
+        self.count += 1
+        delta = q - self.mean
+        self.mean += delta / self.count
+        if self.dense:
+            self.m2 += np.outer(delta, q - self.mean)
+        else:
+            self.m2 += delta * (q - self.mean)
+
+        if self.draws < self.window_end:
+            return None
+
+        n = self.count
+        cov = None
+        if n > 1:
+            cov = self.m2 / (n - 1)
+            # shrink towards a small multiple of the identity
+            if self.dense:
+                identity = np.eye(self.n)
+            else:
+                identity = np.ones(self.n)
+            cov = (n / (n + 5.)) * cov + 1e-3 * (5. / (n + 5.)) * identity
+
+        self.window *= 2
+        self.set_window_end(self.draws)
+        self.reset()
+        return cov
+
+
 try:
     import scikits.sparse.cholmod as cholmod
     chol_available = True
@@ -1,34 +1,50 @@
 # Modified from original implementation by Dominik Wabersich (2013)
 
-from .arraystep import ArrayStep, Competence
-from ..model import modelcontext
-from ..theanof import inputvars
+from .arraystep import ArrayStepShared, Competence
+from .gibbs import elemwise_logpt
+from ..model import modelcontext, ValueGradFunction
+from ..theanof import inputvars, make_shared_replacements
 from ..vartypes import continuous_types
-from numpy import floor, abs, atleast_1d, empty, isfinite, sum, resize
+from numpy import floor, abs, atleast_1d, empty, isfinite, sum, resize, ones
+import theano.tensor as tt
 from numpy.random import standard_exponential, random, uniform
 
 __all__ = ['Slice']
 
 
-class Slice(ArrayStep):
+class Slice(ArrayStepShared):
     """
-    Univariate slice sampler step method
-    
+    Slice sampler step method
+
+    By default the elements of `vars` are sampled jointly from a
+    hyperrectangle of widths `w` around the current point, which is
+    stepped out and shrunk as in the univariate slice sampler. With
+    `elemwise` every element of the variable is slice sampled on its own,
+    all at once.
+    While tuning, `w` is set to twice the running mean of the absolute
+    step sizes, averaged over the `n_tunes` steps so far.
+
     Parameters
     ----------
     vars : list
         List of variables for sampler.
-    w : float
-        Initial width of slice (Defaults to 1).
+    w : float or array
+        Initial width of slice, per element (Defaults to 1).
     tune : bool
         Flag for tuning (Defaults to True).
+    elemwise : bool
+        Slice sample every element of a single variable at once, from the
+        elementwise log-density of the factors that depend on the variable.
+        Only valid when the elements are conditionally independent.
+        Defaults to False.
     model : PyMC Model
         Optional model for sampling step. Defaults to None (taken from context).
     
     """
     default_blocked = False
     
-    def __init__(self, vars=None, w=1, tune=True, model=None, **kwargs):
+    def __init__(self, vars=None, w=1, tune=True, elemwise=False, model=None,
+                 **kwargs):
 
         model = modelcontext(model)
 
@@ -38,15 +54,42 @@ class Slice(ArrayStep):
 
         self.w = w
         self.tune = tune
-        self.w_tune = []
+        self.n_tunes = 0
         self.model = model
 
-        super(Slice, self).__init__(vars, [model.fastlogp], **kwargs)
+        shared = make_shared_replacements(vars, model)
+        self.elemwise = elemwise
+        if elemwise:
+            if len(vars) != 1:
+                raise ValueError('Elementwise Slice needs a single variable')
+            self.logp = ValueGradFunction(
+                tt.flatten(elemwise_logpt(model, vars[0])), vars, shared,
+                grad=False)
+        else:
+            self.logp = model.logp_dlogp_function(vars, shared=shared, grad=False,
+                                                  conditional=True)
+
+        super(Slice, self).__init__(vars, shared, **kwargs)
+
+    def astep(self, q0):
+        self.w = resize(self.w, len(q0))
+
+        if self.elemwise:
+            q = self.elemwise_step(q0)
+        else:
+            q = self.blocked_step(q0)
+
+        if self.tune:
+            # Tune the width to twice the running mean of the step size
+            self.n_tunes += 1
+            self.w = self.w + (2 * abs(q0 - q) - self.w) / self.n_tunes
+
+        return q
 
-    def astep(self, q0, logp):
+    def blocked_step(self, q0):
+        logp = self.logp
 
         q = q0.copy()
-        self.w = resize(self.w, len(q))
 
         y = logp(q0) - standard_exponential()
 
@@ -83,10 +126,40 @@ class Slice(ArrayStep):
             elif (qi < q).all():
                 ql = qi
 
-        if self.tune:
-            # Tune sampler parameters
-            self.w_tune.append(abs(q0 - q))
-            self.w = 2 * sum(self.w_tune, 0) / len(self.w_tune)
+        return q
+
+    def elemwise_step(self, q0):
+        logp = self.logp
+
+        y = logp(q0) - standard_exponential(len(q0))
+
+        # Stepping out, for all elements at once
+        ql = q0 - uniform(0, self.w)
+        qr = ql + self.w
+
+        out = y < logp(ql)
+        while out.any():
+            ql[out] -= self.w[out]
+            out[out] = (y < logp(ql))[out]
+
+        out = y < logp(qr)
+        while out.any():
+            qr[out] += self.w[out]
+            out[out] = (y < logp(qr))[out]
+
+        # Shrinkage, until every element is inside its slice
+        q = q0.copy()
+        todo = ones(len(q0), dtype=bool)
+        while todo.any():
+            qi = q.copy()
+            qi[todo] = uniform(ql[todo], qr[todo])
+            inside = todo & (logp(qi) > y)
+            q[inside] = qi[inside]
+            todo &= ~inside
+            right = todo & (qi > q0)
+            qr[right] = qi[right]
+            left = todo & (qi < q0)
+            ql[left] = qi[left]
 
         return q
 
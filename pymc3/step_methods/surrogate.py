@@ -0,0 +1,81 @@
+'''
+Gaussian process emulator of an expensive log-likelihood.
+'''
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
+
+__all__ = ['GPSurrogate']
+
+
+class GPSurrogate(object):
+    """
+    Gaussian process regression of the log-likelihood on the parameters, with
+    a squared exponential kernel.
+
+    The length scales are set from the spread of the points with Silverman's
+    rule of thumb, and the signal variance from the variance of the
+    log-likelihoods, so that fitting needs no optimisation.
+
+    Parameters
+    ----------
+    tol : float
+        Largest predictive standard deviation of the log-likelihood for which
+        a prediction is trusted
+    max_points : int
+        Number of most recent points the emulator is fitted to
+    noise : float
+        Nugget added to the diagonal of the kernel matrix, relative to the
+        signal variance
+    """
+
+    def __init__(self, tol=1., max_points=1000, noise=1e-6):
+        self.tol = tol
+        self.max_points = max_points
+        self.noise = noise
+        self.X = None
+        self.y = None
+        self.fitted = False
+
+    def add(self, X, y):
+        """Add points X (n x dimensions) with log-likelihoods y and refit."""
+        X = np.atleast_2d(X)
+        y = np.ravel(y)
+        finite = np.isfinite(y)
+        X, y = X[finite], y[finite]
+        if self.X is not None:
+            X = np.vstack([self.X, X])
+            y = np.concatenate([self.y, y])
+        self.X = X[-self.max_points:]
+        self.y = y[-self.max_points:]
+        self.fit()
+
+    def fit(self):
+        n, d = self.X.shape
+        if n < 2:
+            return
+        self.scale = self.X.std(axis=0) * n ** (-1. / (d + 4))
+        self.scale[self.scale == 0] = 1.
+        self.mean = self.y.mean()
+        self.var = self.y.var() or 1.
+
+        K = self.kernel(self.X, self.X)
+        K[np.diag_indices(n)] += self.noise * self.var
+        self.chol = cho_factor(K, lower=True)
+        self.alpha = cho_solve(self.chol, self.y - self.mean)
+        self.fitted = True
+
+    def kernel(self, A, B):
+        sq = (((A[:, None, :] - B[None, :, :]) / self.scale) ** 2).sum(-1)
+        return self.var * np.exp(-.5 * sq)
+
+    def predict(self, x, return_sd=False):
+        """
+        Predictive mean of the log-likelihood at x, and its predictive
+        standard deviation if return_sd.
+        """
+        k = self.kernel(np.atleast_2d(x), self.X)[0]
+        mean = self.mean + k.dot(self.alpha)
+        if not return_sd:
+            return mean
+        v = solve_triangular(self.chol[0], k, lower=True)
+        return mean, np.sqrt(max(self.var - v.dot(v), 0.))
@@ -0,0 +1,204 @@
+'''
+Replica exchange (parallel tempering) sampling across processes.
+'''
+import multiprocessing
+
+import numpy as np
+from numpy.random import randint, seed, uniform
+
+from .compound import CompoundStep
+from .metropolis import Metropolis
+from ..backends.base import MultiTrace
+from ..blocking import ArrayPoint
+from ..model import modelcontext, Point
+from ..progressbar import progress_bar
+
+__all__ = ['sample_tempered']
+
+
+def sample_tempered(draws, step=None, betas=None, njobs=2, start=None,
+                    trace=None, swap_interval=10, tune=None, progressbar=True,
+                    model=None, random_seed=None):
+    """
+    Draw samples with replica exchange Monte Carlo (parallel tempering).
+
+    Every replica samples the posterior with its log-probability multiplied
+    by an inverse temperature beta. The replica with beta=1 runs in this
+    process and the others run in one worker process each. Every
+    `swap_interval` steps, the states of neighbouring replicas are exchanged
+    with the Metropolis acceptance probability
+    exp((beta_i - beta_j) * (logp_j - logp_i)). Only the beta=1 replica is
+    recorded.
+
+    Parameters
+    ----------
+    draws : int
+        The number of samples to draw
+    step : function or list of functions
+        Step methods used by every replica. All of them need a `beta`
+        attribute, as Metropolis has. Defaults to Metropolis on all
+        variables.
+    betas : array
+        Inverse temperatures of the replicas, one of which has to be 1.
+        Defaults to 0.5 ** arange(njobs).
+    njobs : int
+        Number of replicas, if betas is not given
+    start : dict
+        Starting point in parameter space (or partial point) of all replicas.
+        Defaults to model.test_point.
+    trace : backend, list, or MultiTrace
+        This should be a backend instance, a list of variables to track, or
+        a MultiTrace object with past values. If None or a list of variables,
+        the NDArray backend is used.
+    swap_interval : int
+        Number of steps of every replica between exchanges
+    tune : int
+        Number of iterations to tune, if applicable (defaults to None)
+    progressbar : bool
+        Flag for progressbar
+    model : Model (optional if in `with` context)
+    random_seed : int
+        Random seed
+
+    Returns
+    -------
+    MultiTrace object with the samples of the beta=1 replica
+    """
+    from ..sampling import _choose_backend, stop_tuning
+
+    model = modelcontext(model)
+    draws = int(draws)
+    if draws < 1:
+        raise ValueError('Argument `draws` should be above 0.')
+
+    if betas is None:
+        betas = 0.5 ** np.arange(njobs)
+    betas = np.sort(np.asarray(betas, dtype='float64'))[::-1]
+    if betas[0] != 1:
+        raise ValueError('One of the betas has to be 1')
+
+    seed(random_seed)
+    if step is None:
+        step = Metropolis(model=model)
+    try:
+        step = CompoundStep(step)
+    except TypeError:
+        pass
+    untempered = _untempered(step)
+    if untempered:
+        raise ValueError('Step methods {} can not be tempered, all step '
+                         'methods need a `beta` attribute as Metropolis '
+                         'has'.format(', '.join(untempered)))
+    _set_beta(step, 1.)
+
+    point = model.test_point
+    point.update(start or {})
+    point = ArrayPoint(model.vars, Point(point, model=model))
+
+    logp = model.fastlogp
+    states = [_copy(point) for _ in betas]
+    logps = np.repeat(logp(point), len(betas))
+
+    conns = []
+    procs = []
+    for beta, replica_seed in zip(betas[1:], randint(2 ** 30, size=len(betas) - 1)):
+        conn, child_conn = multiprocessing.Pipe()
+        proc = multiprocessing.Process(
+            target=_replica,
+            args=(child_conn, step, beta, model.vars, logp, tune, replica_seed))
+        proc.daemon = True
+        proc.start()
+        # Only the replica holds its end, so that its exit closes the pipe
+        child_conn.close()
+        conns.append(conn)
+        procs.append(proc)
+
+    strace = _choose_backend(trace, 0, model=model)
+    strace.setup(draws, 0)
+
+    progress = progress_bar(draws)
+    i = 0
+    offset = 0
+    try:
+        while i < draws:
+            n = min(swap_interval, draws - i)
+            for conn, state in zip(conns, states[1:]):
+                conn.send((state, n))
+
+            for _ in range(n):
+                if i == tune:
+                    step = stop_tuning(step)
+                point = step.step(point)
+                strace.record(point)
+                if progressbar:
+                    progress.update(i)
+                i += 1
+
+            states[0] = _copy(point)
+            logps[0] = logp(point)
+            for k, conn in enumerate(conns, 1):
+                try:
+                    states[k], logps[k] = conn.recv()
+                except EOFError:
+                    raise RuntimeError('The replica with beta={} '
+                                       'stopped'.format(betas[k]))
+
+            # Alternate between exchanging the even and the odd neighbours
+            swapped = False
+            for k in range(offset, len(betas) - 1, 2):
+                log_ratio = (betas[k] - betas[k + 1]) * (logps[k + 1] - logps[k])
+                if np.log(uniform()) < log_ratio:
+                    states[k], states[k + 1] = states[k + 1], states[k]
+                    logps[k], logps[k + 1] = logps[k + 1], logps[k]
+                    swapped = swapped or k == 0
+            if swapped:
+                point = ArrayPoint(model.vars, states[0])
+            offset = 1 - offset
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for conn, proc in zip(conns, procs):
+            try:
+                conn.send(None)
+            except (IOError, OSError):  # the replica has stopped
+                pass
+            proc.join()
+
+    strace.close()
+    return MultiTrace([strace])
+
+
+def _replica(conn, step, beta, vars, logp, tune, random_seed):
+    from ..sampling import stop_tuning
+
+    seed(random_seed)
+    _set_beta(step, beta)
+    i = 0
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        state, n = msg
+        point = ArrayPoint(vars, state)
+        for _ in range(n):
+            if i == tune:
+                step = stop_tuning(step)
+            point = step.step(point)
+            i += 1
+        conn.send((_copy(point), logp(point)))
+
+
+def _untempered(step):
+    """Names of the step methods without an inverse temperature."""
+    methods = getattr(step, 'methods', [step])
+    return [type(s).__name__ for s in methods if not hasattr(s, 'beta')]
+
+
+def _set_beta(step, beta):
+    """Set the inverse temperature of all step methods."""
+    for s in getattr(step, 'methods', [step]):
+        s.beta = beta
+
+
+def _copy(point):
+    return {var: np.array(value) for var, value in point.items()}
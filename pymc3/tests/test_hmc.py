@@ -1,7 +1,7 @@
 import pymc3 as pm
 import numpy as np
 from . import models
-from pymc3.step_methods.hmc import leapfrog, Hamiltonian
+from pymc3.step_methods.hmc import leapfrog, leapfrog_logp, Hamiltonian
 from .checks import close_to
 from ..blocking import DictToArrayBijection
 
@@ -16,7 +16,8 @@ def test_leapfrog_reversible():
 
     bij = DictToArrayBijection(step.ordering, start)
 
-    logp, dlogp = list(map(bij.mapf, step.fs))
+    logp = bij.mapf(model.fastlogp)
+    dlogp = bij.mapf(model.fastdlogp(model.vars))
     H = Hamiltonian(logp, dlogp, step.potential)
 
     q0 = bij.map(start)
@@ -30,3 +31,30 @@ def test_leapfrog_reversible():
 
             close_to(q, q0, 1e-8, str((L, e)))
             close_to(-p, p0, 1e-8, str((L, e)))
+
+
+def test_leapfrog_logp():
+    n = 3
+    start, model, _ = models.non_normal(n)
+
+    with model:
+        h = pm.find_hessian(start, model=model)
+        step = pm.HamiltonianMC(model.vars, h, model=model)
+
+    bij = DictToArrayBijection(step.ordering, start)
+
+    logp = bij.mapf(model.fastlogp)
+    dlogp = bij.mapf(model.fastdlogp(model.vars))
+    H = Hamiltonian(logp, dlogp, step.potential)
+
+    q0 = bij.map(start)
+    p0 = np.ones(n)*.05
+    q, p = leapfrog(H, q0, p0, 5, .1)
+    logp0, dlogp0 = step.logp_dlogp(q0)
+    q1, p1, logp1, dlogp1 = leapfrog_logp(step.logp_dlogp, step.potential,
+                                          q0, p0, logp0, dlogp0, 5, .1)
+
+    close_to(q1, q, 1e-8)
+    close_to(p1, p, 1e-8)
+    close_to(logp1, logp(q1), 1e-8)
+    close_to(dlogp1, dlogp(q1), 1e-8)
@@ -0,0 +1,125 @@
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import numpy.testing as npt
+import pymc3
+from pymc3.tests import backend_fixtures as bf
+from pymc3.tests.models import simple_init
+from pymc3.backends import memmap, ndarray
+
+
+class TestMemmap0dSampling(bf.SamplingTestCase):
+    backend = memmap.Memmap
+    name = 'memmap-db'
+    shape = ()
+
+
+class TestMemmap1dSampling(bf.SamplingTestCase):
+    backend = memmap.Memmap
+    name = 'memmap-db'
+    shape = 2
+
+
+class TestMemmap2dSampling(bf.SamplingTestCase):
+    backend = memmap.Memmap
+    name = 'memmap-db'
+    shape = (2, 3)
+
+
+class TestMemmap0dSelection(bf.SelectionTestCase):
+    backend = memmap.Memmap
+    name = 'memmap-db'
+    shape = ()
+
+
+class TestMemmap1dSelection(bf.SelectionTestCase):
+    backend = memmap.Memmap
+    name = 'memmap-db'
+    shape = 2
+
+
+class TestMemmap2dSelection(bf.SelectionTestCase):
+    backend = memmap.Memmap
+    name = 'memmap-db'
+    shape = (2, 3)
+
+
+class TestMemmapDumpLoad(bf.DumpLoadTestCase):
+    backend = memmap.Memmap
+    load_func = staticmethod(memmap.load)
+    name = 'memmap-db'
+    shape = (2, 3)
+
+
+class TestMemmapPickle(bf.ModelBackendSampledTestCase):
+    backend = memmap.Memmap
+    name = 'memmap-db'
+    shape = (2, 3)
+
+    def test_pickle_maps_values(self):
+        for chain in self.mtrace.chains:
+            strace = self.mtrace._straces[chain]
+            unpickled = pickle.loads(pickle.dumps(strace, -1))
+            self.assertEqual(len(unpickled), len(strace))
+            for varname in self.test_point:
+                values = unpickled.get_values(varname)
+                self.assertIsInstance(values, np.memmap)
+                npt.assert_equal(values, self.expected[chain][varname])
+                # Both traces map the same file.
+                values[0] = -1
+                values.flush()
+                npt.assert_equal(strace.get_values(varname)[0], -1)
+                values[0] = self.expected[chain][varname][0]
+
+
+class TestNDArrayMemmapEquality(bf.BackendEqualityTestCase):
+    backend0 = ndarray.NDArray
+    name0 = None
+    backend1 = memmap.Memmap
+    name1 = 'memmap-db'
+    shape = (2, 3)
+
+
+class TestMemmapInterruptLoad(bf.ModelBackendSetupTestCase):
+    backend = memmap.Memmap
+    name = 'memmap-db'
+    shape = (2, 3)
+
+    def test_load_interrupted_chain(self):
+        point = {varname: np.tile(7, value.shape)
+                 for varname, value in self.test_point.items()}
+        self.strace.record(point=point)
+        self.strace.close()
+
+        with self.model:
+            trace = memmap.load(self.name)
+        self.assertEqual(len(trace), 1)
+        for varname, value in point.items():
+            values = trace.get_values(varname, chains=[self.chain])
+            self.assertEqual(values.shape, (1, ) + value.shape)
+            npt.assert_equal(values[0], value)
+            npt.assert_equal(np.load(self.strace._filename(varname)),
+                             values)
+
+
+def test_shortcut_removes_old_chains():
+    model, start, _, _ = simple_init()
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    os.chdir(tmpdir)
+    try:
+        with model:
+            step = pymc3.Metropolis()
+            pymc3.sample(5, step, start, trace='memmap', chain=3,
+                         progressbar=False)
+            trace = pymc3.sample(7, step, start, trace='memmap',
+                                 progressbar=False)
+            loaded = memmap.load('mcmc-memmap')
+        assert loaded.chains == [0]
+        npt.assert_equal(loaded['x'], trace['x'])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
@@ -36,3 +36,51 @@ def test_deterministic():
 
     assert model.y == y
     assert model['y'] == y
+
+
+def test_conditional_logpt():
+    with pm.Model() as model:
+        mu = Normal('mu', 0, 1)
+        x = Normal('x', mu, 1, shape=3)
+        y = Normal('y', 0, 1)
+        pm.Potential('z', -y ** 2)
+        Normal('obs', x, 1, observed=np.zeros(3))
+
+    point = model.test_point
+    for vars, factors in [([mu], [mu, x]),
+                          ([x], [x, model.obs]),
+                          ([y], [y]),
+                          ([mu, y], [mu, x, y])]:
+        logp = model.fn(model.conditional_logpt(vars))(point)
+        expected = sum(np.sum(factor.logp(point)) for factor in factors)
+        if y in vars:
+            expected -= point['y'] ** 2
+        close_to(logp, expected, 1e-6)
+
+
+def test_logp_dlogp_function_order():
+    with pm.Model() as model:
+        x = Normal('x', 0, 1, shape=2)
+        y = Normal('y', 1, 2, shape=3)
+
+    point = {'x': np.array([.1, .2]), 'y': np.array([.3, .4, .5])}
+    for vars in [[x, y], [y, x]]:
+        f = model.logp_dlogp_function(vars)
+        assert [v.var for v in f.ordering.vmap] == [v.name for v in vars]
+        q = np.concatenate([point[v.name] for v in vars])
+        close_to(f(q)[0], model.logp(point), 1e-8)
+
+
+def test_logp_dlogp_function_not_shared():
+    with pm.Model() as model:
+        x = Normal('x', 0, 1)
+        y = Normal('y', x, 1)
+
+    f1 = model.logp_dlogp_function([x])
+    f2 = model.logp_dlogp_function([x])
+    assert f1 is not f2
+    f1.set_point({'y': np.array(3.)})
+    f2.set_point({'y': np.array(0.)})
+    q = np.zeros(1)
+    close_to(f1(q)[0], model.logp({'x': 0., 'y': 3.}), 1e-8)
+    close_to(f2(q)[0], model.logp({'x': 0., 'y': 0.}), 1e-8)
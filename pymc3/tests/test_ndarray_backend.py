@@ -66,6 +66,28 @@ class TestMultiTrace(bf.ModelBackendSetupTestCase):
 
 
 
+class TestNDArrayGrow(bf.ModelBackendSetupTestCase):
+    name = None
+    backend = ndarray.NDArray
+    shape = 2
+
+    def test_grow(self):
+        with self.model:
+            strace = ndarray.NDArray()
+        strace.grow = True
+        strace.setup(10 ** 6, 0)
+        self.assertEqual(len(strace), strace.grow_chunk)
+        for idx in range(2500):
+            strace.record({varname: np.tile(idx, value.shape)
+                           for varname, value in self.test_point.items()})
+        self.assertEqual(len(strace), 4 * strace.grow_chunk)
+        strace.close()
+        self.assertEqual(len(strace), 2500)
+        for varname in self.test_point:
+            values = strace.get_values(varname).reshape(2500, -1)
+            npt.assert_equal(values[:, 0], np.arange(2500))
+
+
 class TestSqueezeCat(unittest.TestCase):
 
     def setUp(self):
@@ -5,6 +5,7 @@ try:
 except ImportError:
     import mock
 import unittest
+import warnings
 
 import pymc3
 from pymc3 import sampling
@@ -42,6 +43,20 @@ def test_iter_sample():
     for i, trace in enumerate(samps):
         assert i == len(trace) - 1, "Trace does not have correct length."
         
+def test_iter_sample_view():
+    model, start, _, _ = simple_init()
+    with model:
+        step = pymc3.Slice()
+    samps = sampling.iter_sample(5, step, start, model=model)
+    copies = []
+    for i, trace in enumerate(samps):
+        assert len(trace) == i + 1
+        assert trace['x'].shape == (i + 1, 2)
+        npt.assert_equal(trace.point(-1)['x'], trace['x'][-1])
+        copies.append(trace[:])
+    assert [len(copy) for copy in copies] == [1, 2, 3, 4, 5]
+    npt.assert_equal(copies[-1]['x'], trace['x'])
+
 def test_parallel_start():
     model, _, _, _ = simple_init()
     with model:
@@ -49,6 +64,92 @@ def test_parallel_start():
     assert tr.get_values('x', chains=0)[0][0] > 0
     assert tr.get_values('x', chains=1)[0][0] < 0
 
+def test_sampling_pool():
+    model, _, step, _ = simple_init()
+    with model:
+        step = pymc3.Metropolis()
+        with sampling.SamplingPool(2) as pool:
+            keys = set()
+            for steps in [step, [step], [step]]:
+                tr = sample(5, steps, njobs=2, pool=pool,
+                            start=[{'x': [10, 10]}, {'x': [-10, -10]}],
+                            random_seed=RSEED)
+                assert tr.chains == [0, 1]
+                assert tr.get_values('x', chains=0)[0][0] > 0
+                assert tr.get_values('x', chains=1)[0][0] < 0
+                assert len(set(pool.loaded)) == 1
+                keys.update(pool.loaded)
+            # the same step method is sent to the workers only once
+            assert len(keys) == 1
+
+            # changed step methods are sent again
+            step.scaling = step.scaling * 2
+            sample(5, step, njobs=2, pool=pool, progressbar=False)
+            assert not keys & set(pool.loaded)
+
+
+class CountingStep(pymc3.Metropolis):
+    def __init__(self, *args, **kwargs):
+        super(CountingStep, self).__init__(*args, **kwargs)
+        self.calls = 0
+
+    def astep(self, q0):
+        self.calls += 1
+        if self.calls > 5:
+            raise ValueError('the step method was reused')
+        return super(CountingStep, self).astep(q0)
+
+
+def test_sampling_pool_new_steps():
+    model, _, _, _ = simple_init()
+    with model:
+        step = CountingStep(tune=True)
+        with sampling.SamplingPool(2) as pool:
+            # more chains than workers, and a second call
+            for _ in range(2):
+                tr = sample(5, step, njobs=4, tune=3, pool=pool,
+                            progressbar=False)
+                assert tr.chains == [0, 1, 2, 3]
+
+
+class UnpicklableStep(pymc3.Metropolis):
+    def __setstate__(self, state):
+        raise ValueError('can not be loaded')
+
+
+def test_sampling_pool_errors():
+    model, _, _, _ = simple_init()
+    with model:
+        step = pymc3.Metropolis()
+        pool = sampling.SamplingPool(2)
+        npt.assert_raises(ValueError, sample, 5, UnpicklableStep(), njobs=2,
+                          pool=pool, progressbar=False)
+        # the workers survive errors
+        sample(5, step, njobs=2, pool=pool, progressbar=False)
+
+        pool.procs[1].terminate()
+        pool.procs[1].join()
+        npt.assert_raises(RuntimeError, sample, 5, step, njobs=2, pool=pool,
+                          progressbar=False)
+        assert not pool.procs
+
+
+def test_sampling_pool_interrupt():
+    model, _, _, _ = simple_init()
+    with model:
+        step = pymc3.Metropolis()
+        with sampling.SamplingPool(2) as pool:
+            procs = list(pool.procs)
+            with mock.patch.object(pool.conns[1], 'recv',
+                                   side_effect=KeyboardInterrupt):
+                npt.assert_raises(KeyboardInterrupt, sample, 5, step,
+                                  njobs=2, pool=pool, progressbar=False)
+            # the trace of the interrupted call is not returned
+            tr = sample(7, step, njobs=2, pool=pool, progressbar=False)
+            assert [len(tr._straces[c]) for c in tr.chains] == [7, 7]
+            assert not set(procs) & set(pool.procs)
+
+
 def test_soft_update_all_present():
     start = {'a': 1, 'b': 2}
     test_point = {'a': 3, 'b': 4}
@@ -143,3 +244,98 @@ class TestChooseBackend(unittest.TestCase):
                                       'name': None}}
         sampling._choose_backend('test_backend', 'chain', shortcuts=shortcuts)
         self.assertTrue(backend.called)
+
+    def test_choose_backend_memmap_shares_directory(self):
+        model, _, _, _ = simple_init()
+        with model:
+            straces = [sampling._choose_backend('memmap', chain)
+                       for chain in range(2)]
+        self.assertEqual([strace.name for strace in straces],
+                         ['mcmc-memmap'] * 2)
+
+
+def test_sample_until_converged():
+    model, start, _, _ = simple_init()
+    with model:
+        step = pymc3.Metropolis()
+        trace = sampling.sample_until_converged(
+            5000, step=step, chunk=200, n_eff=100, start=start,
+            progressbar=False, random_seed=RSEED)
+        assert trace.nchains == 2
+        assert len(trace) < 5000
+        assert len(trace) % 200 == 0
+        assert np.all(np.array(pymc3.effective_n(trace)['x']) >= 100)
+        assert np.all(pymc3.gelman_rubin(trace)['x'] < 1.1)
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            trace = sampling.sample_until_converged(
+                300, step=step, chunk=200, n_eff={'x': 1e6}, start=start,
+                progressbar=False)
+        assert len(trace) == 300
+        assert any('not met' in str(warning.message) for warning in w)
+
+
+def test_sample_until_converged_parallel():
+    model, start, _, _ = simple_init()
+    with model:
+        step = pymc3.Metropolis()
+        trace = sampling.sample_until_converged(
+            5000, step=step, chunk=200, n_eff=100, start=start, njobs=2,
+            progressbar=False, random_seed=RSEED)
+        assert trace.chains == [0, 1]
+        assert len(trace) < 5000
+        assert np.all(pymc3.gelman_rubin(trace)['x'] < 1.1)
+
+        # more chains than workers
+        with sampling.SamplingPool(2) as pool:
+            trace = sampling.sample_until_converged(
+                400, step=step, chunk=200, nchains=3, n_eff={'x': 1e6},
+                start=start, tune=100, pool=pool, progressbar=False)
+            assert trace.chains == [0, 1, 2]
+            assert [len(trace._straces[c]) for c in trace.chains] == [400] * 3
+
+
+class InterruptingStep(pymc3.Metropolis):
+    def __init__(self, *args, **kwargs):
+        super(InterruptingStep, self).__init__(*args, **kwargs)
+        self.calls = 0
+
+    def astep(self, q0):
+        self.calls += 1
+        if self.calls == 250:
+            raise KeyboardInterrupt
+        return super(InterruptingStep, self).astep(q0)
+
+
+def test_sample_until_converged_interrupt():
+    model, start, _, _ = simple_init()
+    with model:
+        step = InterruptingStep()
+        trace = sampling.sample_until_converged(
+            1000, step=step, chunk=100, n_eff={'x': 1e6}, start=start,
+            progressbar=False)
+    # the chunk that was interrupted is left out of every chain
+    assert [len(trace._straces[c]) for c in trace.chains] == [200, 200]
+    assert pymc3.gelman_rubin(trace)['x'].shape == (2,)
+
+
+def test_time_budget():
+    model, start, _, _ = simple_init()
+    with model:
+        step = pymc3.Metropolis()
+        trace = sample(10 ** 6, step, start, tune=10 ** 5, time_budget=1.,
+                       tune_budget=.5, progressbar=False, random_seed=RSEED)
+    draws = trace.draws_per_chain[0]
+    assert 0 < draws < 10 ** 6
+    assert trace['x'].shape == (draws, 2)
+    assert not step.tune
+    assert trace.throughput[0] > 0
+
+    samps = sampling.iter_sample(10 ** 6, step, start, model=model,
+                                 time_budget=.5)
+    for trace in samps:
+        # the arrays are not allocated for all draws
+        assert len(trace._straces[0].strace) < 10 ** 6
+    assert len(trace) < 10 ** 6
+    npt.assert_equal(trace.point(-1)['x'], trace['x'][-1])
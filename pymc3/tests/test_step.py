@@ -1,14 +1,26 @@
 from .checks import close_to
 from .models import simple_model, mv_simple, mv_simple_discrete, simple_2model
 from ..step_methods import MultivariateNormalProposal
-from theano.tensor import constant
+from theano.tensor import constant, exp, log
+import theano.tensor as tt
 from scipy.stats.mstats import moment
 from pymc3.sampling import assign_step_methods, sample
 from pymc3.model import Model
+from pymc3.blocking import ArrayPoint
+from pymc3.backends import text
 from pymc3.step_methods import NUTS, BinaryMetropolis, BinaryGibbsMetropolis, Metropolis, Constant, ElemwiseCategorical, Slice, CompoundStep, MultivariateNormalProposal, HamiltonianMC
-from pymc3.distributions import Binomial, Normal, Bernoulli, Categorical
-from numpy.testing import assert_almost_equal
+from pymc3.step_methods import Ensemble, sample_ensemble, sample_tempered
+from pymc3.step_methods import DelayedAcceptanceMetropolis, GPSurrogate
+from pymc3.step_methods import ATMCMC, ATMIP_sample
+from pymc3.step_methods.quadpotential import WindowedAdaptation
+from pymc3.step_methods import ConjugateGibbs, AdaptiveMetropolis, NormalProposal, CauchyProposal, LaplaceProposal, PoissonProposal
+from pymc3.model import Potential, Deterministic
+from pymc3.distributions import Binomial, Normal, Bernoulli, Categorical, Gamma, Beta, Poisson, Uniform
+from numpy.testing import assert_almost_equal, assert_raises
 import numpy as np
+import os
+import shutil
+import tempfile
 
 def check_stat(name, trace, var, stat, value, bound):
     s = stat(trace[var][2000:], axis=0)
@@ -21,6 +33,7 @@ def test_step_continuous():
     with model:
         mh = Metropolis()
         slicer = Slice()
+        adaptive_mh = AdaptiveMetropolis()
         hmc = HamiltonianMC(scaling=C, is_cov=True, blocked=False)
         nuts = NUTS(scaling=C, is_cov=True, blocked=False)
 
@@ -35,7 +48,7 @@ def test_step_continuous():
 
 
     steps = [slicer, hmc, nuts, mh_blocked, hmc_blocked,
-             slicer_blocked, nuts_blocked, compound]
+             slicer_blocked, nuts_blocked, compound, adaptive_mh]
 
     unc = np.diag(C) ** .5
     check = [('x', np.mean, mu, unc / 10.),
@@ -136,3 +149,480 @@ def test_assign_step_methods():
         steps = assign_step_methods(model, [])
 
         assert isinstance(steps, Metropolis)
+
+def test_nuts_max_treedepth():
+    start, model, (mu, C) = mv_simple()
+
+    with model:
+        step = NUTS(scaling=C, is_cov=True, max_treedepth=2)
+        sample(50, step, start, random_seed=1, progressbar=False)
+
+    assert 1 <= step.tree_depth <= 2
+
+
+def test_adapt_scaling():
+    start, model, (mu, C) = mv_simple()
+
+    for adapt_scaling in ['diag', 'dense']:
+        with model:
+            steps = [NUTS(scaling=np.ones(3), is_cov=True, adapt_scaling=adapt_scaling),
+                     HamiltonianMC(scaling=np.ones(3), is_cov=True, adapt_scaling=adapt_scaling)]
+        for step in steps:
+            sample(1000, step, start, tune=1000, model=model, random_seed=1)
+            if adapt_scaling == 'dense':
+                var = np.diag(step.potential.A)
+            else:
+                var = step.potential.v
+            close_to(np.log(var), np.log(np.diag(C)), 1.)
+
+
+def test_adapt_scaling_without_tune():
+    start, model, _ = mv_simple()
+    with model:
+        step = NUTS(scaling=np.ones(3), is_cov=True, adapt_scaling='diag')
+    sample(300, step, start, model=model, random_seed=1, progressbar=False)
+    assert np.all(step.potential.v == 1)
+
+
+def test_adaptation_windows():
+    def window_ends(tune, **kwargs):
+        adaptation = WindowedAdaptation(2, **kwargs)
+        adaptation.set_tune(tune)
+        return [i + 1 for i in range(2000)
+                if adaptation.update(np.random.normal(size=2)) is not None]
+
+    assert window_ends(1000) == [100, 150, 250, 450, 950]
+    assert window_ends(500) == [100, 150, 250, 450]
+    assert window_ends(499) == [100, 150, 449]
+    assert window_ends(150) == [100]
+    # too short for the default buffers and window
+    assert window_ends(100) == [90]
+    assert window_ends(10) == [9]
+    assert window_ends(1) == []
+    assert window_ends(None) == []
+    assert window_ends(200, window=10, buffer=20, term_buffer=30) == [30, 50, 90, 170]
+
+
+def test_array_point_step():
+    start, model = simple_2model()
+
+    def steps():
+        with model:
+            return [Metropolis(), BinaryGibbsMetropolis([model.y])]
+
+    for dict_step, array_step in zip(steps(), steps()):
+        np.random.seed(1)
+        dict_point = dict_step.step(dict(start))
+
+        point = ArrayPoint(model.vars, start)
+        np.random.seed(1)
+        array_point = array_step.step(point)
+
+        assert array_point is point
+        changed = any(np.any(point[var.name] != start[var.name])
+                      for var in model.vars)
+        assert (point.version > 0) == changed
+        for var in model.vars:
+            assert_almost_equal(point[var.name], dict_point[var.name])
+            assert point[var.name].dtype == dict_point[var.name].dtype
+
+
+def test_metropolis_logp_cache():
+    start, model = simple_2model()
+
+    with model:
+        steps = [Metropolis([model.x]), BinaryMetropolis([model.y])]
+
+    np.random.seed(1)
+    point = ArrayPoint(model.vars, start)
+    for _ in range(50):
+        for step in steps:
+            point = step.step(point)
+            logp = model.fn(model.conditional_logpt(step.vars))
+            assert_almost_equal(step.logp0, logp(point))
+
+
+def test_proposal_blocks():
+    s = np.ones(3)
+    for proposal in [NormalProposal, CauchyProposal, LaplaceProposal,
+                     PoissonProposal]:
+        dist = proposal(s)
+        assert dist().shape == (3,)
+        assert dist(10).shape == (10, 3)
+    assert MultivariateNormalProposal(np.eye(3))(10).shape == (10, 3)
+
+
+class SingleDrawProposal(object):
+    def __init__(self, s):
+        self.s = s
+
+    def __call__(self):
+        return np.random.normal(scale=self.s)
+
+
+def test_single_draw_proposal():
+    start, model, _ = simple_model()
+    with model:
+        step = Metropolis(proposal_dist=SingleDrawProposal)
+        assert step.proposal_buffer == 1
+        trace = sample(50, step, start, progressbar=False, random_seed=1)
+    assert len(np.unique(trace['x'])) > 1
+
+
+def test_adaptive_metropolis_covariance():
+    start, model, (mu, C) = mv_simple()
+
+    with model:
+        step = AdaptiveMetropolis(S=C, cov_weight=5)
+
+    point = ArrayPoint(model.vars, start)
+    q0 = point['x'].copy()
+    draws = []
+    for _ in range(200):
+        point = step.step(point)
+        draws.append(point['x'].copy())
+
+    draws = np.array(draws)
+    n = 5 + len(draws)
+    mean = (5 * q0 + draws.sum(0)) / n
+    cov = (5 * (C + np.outer(q0 - mean, q0 - mean)) +
+           np.dot((draws - mean).T, draws - mean)) / n
+    assert_almost_equal(step.mean, mean)
+    assert_almost_equal(step.chol.dot(step.chol.T), cov)
+
+
+def test_elemwise_metropolis():
+    data = np.linspace(-2, 2, 20)
+    with Model() as model:
+        x = Normal('x', 0, 1, shape=20)
+        Normal('y', x, 1, observed=data)
+        step = Metropolis([x], elemwise=True)
+        trace = sample(4000, step, model.test_point, random_seed=1)
+
+    close_to(trace['x'][1000:].mean(0), data / 2., .1)
+    close_to(trace['x'][1000:].std(0), .5 ** .5, .1)
+    assert_almost_equal(step.logp0, step.logp(trace['x'][-1]))
+
+
+def test_elemwise_shape_mismatch():
+    with Model():
+        x = Normal('x', 0, 1, shape=20)
+        Normal('y', x[:10], 1, observed=np.zeros(10))
+        assert_raises(ValueError, Metropolis, [x], elemwise=True)
+
+
+def test_elemwise_slice():
+    data = np.linspace(-2, 2, 20)
+    with Model() as model:
+        x = Normal('x', 0, 1, shape=20)
+        Normal('y', x, 1, observed=data)
+        step = Slice([x], elemwise=True)
+        trace = sample(3000, step, model.test_point, random_seed=1)
+
+    close_to(trace['x'][500:].mean(0), data / 2., .1)
+    close_to(trace['x'][500:].std(0), .5 ** .5, .1)
+    assert step.w.shape == (20,)
+
+
+def test_binary_gibbs_metropolis():
+    p = .3
+    data = np.array([0., 1.] * 20)
+    like1 = np.exp(-.5 * (data - 1) ** 2)
+    like0 = np.exp(-.5 * data ** 2)
+    posterior = p * like1 / (p * like1 + (1 - p) * like0)
+
+    for elemwise in [False, True]:
+        with Model() as model:
+            z = Bernoulli('z', p, shape=40)
+            Normal('y', z, 1, observed=data)
+            step = BinaryGibbsMetropolis([z], elemwise=elemwise)
+            trace = sample(3000, step, model.test_point, random_seed=1)
+
+        close_to(trace['z'][500:].mean(0), posterior, .07)
+
+    with model:
+        Potential('pot', -z.sum())
+        assert_raises(ValueError, BinaryGibbsMetropolis, [z], elemwise=True)
+
+    with Model():
+        z = Bernoulli('z', p, shape=40)
+        Normal('y', z[:20], 1, observed=data[:20])
+        assert_raises(ValueError, BinaryGibbsMetropolis, [z], elemwise=True)
+
+
+def test_elemwise_categorical():
+    p = np.array([.2, .3, .5])
+    data = np.array([0., 1., 2., 5.] * 10)
+    like = np.exp(-.5 * (data[:, None] - np.arange(3)) ** 2) * p
+    posterior = like / like.sum(1, keepdims=True)
+
+    with Model() as model:
+        x = Categorical('x', p, shape=40)
+        Normal('y', x, 1, observed=data)
+        step = ElemwiseCategorical([x])
+        trace = sample(2000, step, model.test_point, random_seed=1)
+
+    for k in range(3):
+        close_to((trace['x'] == k).mean(0), posterior[:, k], .05)
+
+
+def test_conjugate_gibbs():
+    data = np.array([1., 2., 0., 3., 4.])
+    n = len(data)
+    with Model() as model:
+        mu = Normal('mu', 1., tau=2.)
+        Normal('x', mu, tau=3., observed=data)
+        tau = Gamma('tau', 2., 3.)
+        Normal('y', 0., tau=tau, observed=data)
+        rate = Gamma('rate', 2., 3., shape=2)
+        Poisson('z', rate, observed=np.array([data, data[::-1]]).T)
+        p = Beta('p', 2., 3.)
+        Binomial('w', 5, p, observed=data)
+
+        steps = assign_step_methods(model, [])
+        assert all(isinstance(s, ConjugateGibbs) for s in steps.methods)
+        trace = sample(3000, steps, model.test_point, random_seed=1)
+
+    posteriors = [
+        ('mu', (2. + 3. * data.sum()) / (2. + 3. * n), (2. + 3. * n) ** -.5),
+        ('tau', (2. + n / 2.) / (3. + (data ** 2).sum() / 2.),
+         (2. + n / 2.) ** .5 / (3. + (data ** 2).sum() / 2.)),
+        ('rate', (2. + data.sum()) / (3. + n),
+         (2. + data.sum()) ** .5 / (3. + n)),
+        ('p', (2. + data.sum()) / (5. + 5 * n),
+         ((2. + data.sum()) * (3. + 5 * n - data.sum()) /
+          ((5. + 5 * n) ** 2 * (6. + 5 * n))) ** .5)]
+    for name, mean, sd in posteriors:
+        close_to(trace[name].mean(0), mean, sd / 10.)
+        close_to(trace[name].std(0), sd, sd / 10.)
+
+
+def test_ensemble():
+    start, model, (mu, C) = mv_simple()
+    unc = np.diag(C) ** .5
+
+    for move, njobs in [('stretch', 1), ('de', 1), ('stretch', 2)]:
+        with model:
+            step = Ensemble(n_walkers=20, move=move, njobs=njobs)
+            trace = sample_ensemble(1500, step, start, progressbar=False,
+                                    random_seed=1)
+        assert trace.nchains == 20
+        x = trace.get_values('x', burn=500, combine=True)
+        close_to(x.mean(0), mu, unc / 10.)
+        close_to(x.std(0), unc, unc / 10.)
+
+
+def test_ensemble_interrupt():
+    start, model, _ = mv_simple()
+    with model:
+        step = Ensemble(n_walkers=8, njobs=2)
+    move = step.step
+    calls = []
+
+    def interrupted_step(population, logps):
+        calls.append(1)
+        if len(calls) > 10:
+            raise KeyboardInterrupt
+        return move(population, logps)
+
+    step.step = interrupted_step
+    trace = sample_ensemble(100, step, start, progressbar=False, model=model)
+    assert step.pool is None
+    assert trace.nchains == 8
+    assert len(trace) == 10
+
+
+def test_parallel_tempering():
+    with Model() as model:
+        x = Normal('x', 0., sd=10.)
+        Potential('modes', log(exp(-(x - 5.) ** 2 / .5) +
+                               exp(-(x + 5.) ** 2 / .5)))
+
+        trace = sample_tempered(3000, Metropolis(scaling=.5),
+                                betas=[1., .3, .1, .03], start={'x': 5.},
+                                progressbar=False, random_seed=1)
+    assert len(trace) == 3000
+    # started in one mode, the beta=1 chain only reaches the other by swaps
+    assert .3 < (trace['x'] > 0).mean() < .7
+
+
+class FailingReplicaMetropolis(Metropolis):
+    def astep(self, q0):
+        if self.beta < 1:
+            raise FloatingPointError
+        return super(FailingReplicaMetropolis, self).astep(q0)
+
+
+def test_parallel_tempering_errors():
+    with Model() as model:
+        Normal('x', 0., sd=10.)
+        assert_raises(ValueError, sample_tempered, 10, Slice(),
+                      progressbar=False)
+        assert_raises(RuntimeError, sample_tempered, 10,
+                      FailingReplicaMetropolis(), progressbar=False)
+
+
+def test_delayed_acceptance_metropolis():
+    data = np.array([1., 2., 0., 3., 4.])
+    n = len(data)
+    post_sd = (1. / 4. + n) ** -.5
+    post_mean = data.sum() * post_sd ** 2
+    for approx in [False, True]:
+        with Model() as model:
+            mu = Normal('mu', 0., sd=2.)
+            Normal('x', mu, sd=1., observed=data)
+            # a deliberately poor approximation, the second stage corrects it
+            approx_logp = -.4 * n * (mu - data.mean()) ** 2 if approx else None
+
+            step = DelayedAcceptanceMetropolis(approx_logp=approx_logp,
+                                               scaling=2.)
+            trace = sample(10000, step, random_seed=1)
+        assert step.screened > 0
+        close_to(trace['mu'][2000:].mean(), post_mean, post_sd / 10.)
+        close_to(trace['mu'][2000:].std(), post_sd, post_sd / 10.)
+
+
+def test_gp_surrogate():
+    np.random.seed(1)
+    X = np.random.uniform(-1, 1, size=(300, 2))
+    f = lambda x: -(x ** 2).sum(-1) / .5
+    surrogate = GPSurrogate(tol=.1)
+    surrogate.add(X[:150], f(X[:150]))
+    surrogate.add(X[150:], f(X[150:]))
+    assert surrogate.fitted
+
+    for x in [np.zeros(2), np.array([.5, -.3])]:
+        mean, sd = surrogate.predict(x, return_sd=True)
+        assert_almost_equal(mean, f(x), 1)
+        assert sd < surrogate.tol
+    assert surrogate.predict(np.array([3., 3.]), return_sd=True)[1] > surrogate.tol
+
+
+def test_atmip_sample():
+    mu = np.array([.5, .5])
+    w = .1
+
+    def two_gaussians(x):
+        return log(w * exp(-50. * ((x - mu) ** 2).sum()) +
+                   (1 - w) * exp(-50. * ((x + mu) ** 2).sum()))
+
+    for vectorize in [False, True]:
+        # the initial population is drawn by ATMCMC
+        np.random.seed(1)
+        with Model() as model:
+            X = Uniform('X', shape=2, lower=-2. * np.ones(2),
+                        upper=2. * np.ones(2), testval=-np.ones(2),
+                        transform=None)
+            like = Deterministic('like', two_gaussians(X))
+            Potential('like', like)
+
+            step = ATMCMC(n_chains=200, tune_interval=10,
+                          likelihood_name='like')
+            trace = ATMIP_sample(n_steps=20, step=step, random_seed=1,
+                                 vectorize=vectorize)
+
+        assert trace.nchains == 200
+        x = trace.get_values('X', combine=True)
+        close_to((x[:, 0] > 0).mean(), w, .05)
+        close_to(np.abs(x).mean(0), mu, .05)
+
+
+def test_atmcmc_likelihood_name():
+    with Model():
+        X = Uniform('X', shape=2, lower=np.zeros(2), upper=np.ones(2))
+        Deterministic('like_total', X.sum())
+        assert_raises(ValueError, ATMCMC, n_chains=4, likelihood_name='like')
+
+
+def test_atmip_population_function():
+    with Model() as model:
+        X = Uniform('X', shape=2, lower=np.zeros(2), upper=np.ones(2),
+                    transform=None)
+        like = Deterministic('like', -((tt.sqrt(X) - .5) ** 2).sum())
+        Potential('like', like)
+        step = ATMCMC(n_chains=4, likelihood_name='like')
+
+    f = step.population_function(model)
+    q = np.array([[.2, .3], [-.5, .3], [.9, 1.5], [.5, .5]])
+    logp, likelihood = f(q)
+    inside = np.array([True, False, False, True])
+    assert np.all(np.isneginf(logp[~inside]))
+    assert np.all(np.isneginf(likelihood[~inside]))
+    for row in np.where(inside)[0]:
+        close_to(logp[row], step.logp_forw(q[row]), 1e-8)
+        close_to(likelihood[row], -((np.sqrt(q[row]) - .5) ** 2).sum(), 1e-8)
+
+
+def test_atmip_sample_stage_dump():
+    with Model() as model:
+        X = Uniform('X', shape=2, lower=-2. * np.ones(2),
+                    upper=2. * np.ones(2), transform=None)
+        like = Deterministic('like', -10. * (X ** 2).sum())
+        Potential('like', like)
+        step = ATMCMC(n_chains=20, tune_interval=5, likelihood_name='like')
+
+    # end points of every stage as exchanged in memory
+    stages = []
+    collect_end_points = step.collect_end_points
+
+    def record_end_points(array_population, likelihoods):
+        stages.append((step.stage, array_population.copy(),
+                       np.array(likelihoods)))
+        return collect_end_points(array_population, likelihoods)
+
+    step.collect_end_points = record_end_points
+    homepath = tempfile.mkdtemp()
+    try:
+        trace = ATMIP_sample(n_steps=10, step=step, trace=homepath,
+                             model=model, random_seed=1)
+
+        assert stages
+        for stage, array_population, likelihoods in stages:
+            dumped = text.load(os.path.join(homepath, 'stage_%i' % stage),
+                               model=model)
+            assert dumped.nchains == step.n_chains
+            for chain in dumped.chains:
+                end_point = dumped.point(-1, chain=chain)
+                close_to(end_point['X'], array_population[chain], 1e-8)
+                close_to(end_point['like'], likelihoods[chain], 1e-8)
+
+        final = text.load(os.path.join(homepath, 'stage_final'), model=model)
+        for varname in ['X', 'like']:
+            close_to(final.get_values(varname), trace.get_values(varname),
+                     1e-8)
+    finally:
+        shutil.rmtree(homepath)
+
+
+def test_atmip_sample_surrogate():
+    mu = np.array([.5, .5])
+
+    for mode in ['screen', 'replace']:
+        np.random.seed(1)
+        with Model() as model:
+            X = Uniform('X', shape=2, lower=-2. * np.ones(2),
+                        upper=2. * np.ones(2), testval=-np.ones(2),
+                        transform=None)
+            like = Deterministic('like', -50. * ((X - mu) ** 2).sum())
+            Potential('like', like)
+
+            step = ATMCMC(n_chains=100, tune_interval=10,
+                          likelihood_name='like',
+                          surrogate=GPSurrogate(tol=.5, max_points=200),
+                          surrogate_mode=mode)
+            forward = step.logp_forw
+            calls = []
+
+            def logp_forw(q):
+                calls.append(1)
+                return forward(q)
+
+            step.logp_forw = logp_forw
+            trace = ATMIP_sample(n_steps=20, step=step, random_seed=1)
+
+        assert step.surrogate.fitted
+        # the surrogate saves forward model runs in both modes
+        assert len(calls) < .9 * step.n_chains * 20 * step.stage
+        x = trace.get_values('X', combine=True)
+        close_to(x.mean(0), mu, .05)
+        close_to(x.std(0), .1, .03)
@@ -8,7 +8,7 @@ import numpy as np
 from numpy import exp, log, sqrt
 from ..model import modelcontext, Point
 from ..theanof import hessian_diag, inputvars
-from ..blocking import DictToArrayBijection, ArrayOrdering
+from ..blocking import ArrayOrdering
 
 __all__ = ['approx_hessian', 'find_hessian', 'trace_cov', 'guess_scaling']
 
@@ -34,18 +34,18 @@ def approx_hessian(point, vars=None, model=None):
 
     point = Point(point, model=model)
 
-    bij = DictToArrayBijection(ArrayOrdering(vars), point)
-    dlogp = bij.mapf(model.fastdlogp(vars))
+    logp_dlogp = model.logp_dlogp_function(vars)
+    logp_dlogp.set_point(point)
 
-    def grad_logp(point):
-        return np.nan_to_num(dlogp(point))
+    def grad_logp(x):
+        return np.nan_to_num(logp_dlogp(np.asarray(x, dtype='float64'))[1])
 
     '''
     Find the jacobian of the gradient function at the current position
     this should be the Hessian; invert it to find the approximate
     covariance matrix.
     '''
-    return -Jacobian(grad_logp)(bij.map(point))
+    return -Jacobian(grad_logp)(logp_dlogp.dict_to_array(point))
 
 
 def fixed_hessian(point, vars=None, model=None):
@@ -66,12 +66,7 @@ def fixed_hessian(point, vars=None, model=None):
     vars = inputvars(vars)
 
 
-    point = Point(point, model=model)
-
-    bij = DictToArrayBijection(ArrayOrdering(vars), point)
-    dlogp = bij.mapf(model.fastdlogp(vars))
-
-    rval = np.ones(bij.map(point).size)/10
+    rval = np.ones(ArrayOrdering(vars).dimensions)/10
     return rval
 
 
@@ -9,7 +9,6 @@ from numpy import isfinite, nan_to_num, logical_not
 from ..vartypes import discrete_types, typefilter
 from ..model import modelcontext, Point
 from ..theanof import inputvars
-from ..blocking import DictToArrayBijection, ArrayOrdering
 
 from inspect import getargspec
 
@@ -66,30 +65,40 @@ def find_MAP(start=None, vars=None, fmin=None, return_raw=False,
     allinmodel(vars, model)
 
     start = Point(start, model=model)
-    bij = DictToArrayBijection(ArrayOrdering(vars), start)
+    logp_dlogp = model.logp_dlogp_function(vars)
+    logp_dlogp.set_point(start)
 
-    logp = bij.mapf(model.fastlogp)
-    dlogp = bij.mapf(model.fastdlogp(vars))
+    # The optimizers ask for the value and the gradient at the same point
+    # in separate calls, keep the last result to evaluate both at once.
+    last = {}
 
-    def logp_o(point):
-        return nan_to_high(-logp(point))
+    def logp_dlogp_o(x):
+        x = np.asarray(x, dtype='float64')
+        if 'x' not in last or not np.array_equal(x, last['x']):
+            last['x'] = x.copy()
+            last['value'] = logp_dlogp(x)
+        return last['value']
 
-    def grad_logp_o(point):
-        return nan_to_num(-dlogp(point))
+    def logp_o(x):
+        return nan_to_high(-logp_dlogp_o(x)[0])
+
+    def grad_logp_o(x):
+        return nan_to_num(-logp_dlogp_o(x)[1])
+
+    x0 = logp_dlogp.dict_to_array(start)
 
     # Check to see if minimization function actually uses the gradient
     if 'fprime' in getargspec(fmin).args:
-        r = fmin(logp_o, bij.map(
-            start), fprime=grad_logp_o, *args, **kwargs)
+        r = fmin(logp_o, x0, fprime=grad_logp_o, *args, **kwargs)
     else:
-        r = fmin(logp_o, bij.map(start), *args, **kwargs)
+        r = fmin(logp_o, x0, *args, **kwargs)
 
     if isinstance(r, tuple):
         mx0 = r[0]
     else:
         mx0 = r
 
-    mx = bij.rmap(mx0)
+    mx = logp_dlogp.array_to_dict(mx0, start)
 
     if (not allfinite(mx0) or
         not allfinite(model.logp(mx)) or